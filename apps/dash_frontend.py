@@ -1,7 +1,7 @@
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, ClientsideFunction
 import numpy as np
 import json
 
@@ -11,10 +11,13 @@ from urllib.parse import parse_qs
 from utils import helpers
 from utils import timeline_chart
 from utils import dash_elements
+from utils import trace_artifacts
 from utils.filter_by_radius import filter_by_radius
+from utils.cache_serializers import ensure_geometry
 from utils.get_outline_coords import get_outline_coords
 from utils.ec_analytics import matomo_tracking
-from utils.cached_functions import get_map_data, load_timeseries, get_map_traces
+from utils.cached_functions import get_map_data, load_timeseries, load_timeseries_many, get_map_client_data, \
+    get_map_geometry, map_artifacts
 
 from app import app, slow_cache
 
@@ -37,7 +40,7 @@ LOG_LEVEL = CONFIG["LOG_LEVEL"]
 
 # INITIALIZE CHART OBJECT
 # ================
-CHART = timeline_chart.TimelineChartWindow(TRENDWINDOW, load_timeseries)
+CHART = timeline_chart.TimelineChartWindow(TRENDWINDOW, load_timeseries, load_timeseries_many)
 
 # UPDATE MEASUREMENTS
 # ================
@@ -51,7 +54,7 @@ CONFIG["measurements"] = list(mapdata["_measurement"].unique())
 # ======================
 layout = html.Div(id="dash-layout", children=[
     dcc.Location(id='url', refresh=False),
-    *dash_elements.storage(),
+    *dash_elements.storage(None if map_artifacts is None else trace_artifacts.URL_REFRESH_S),
     dash_elements.mainmap(),
     dash_elements.main_controls(get_map_data(), CONFIG),
     dash_elements.timeline_chart(),
@@ -84,6 +87,8 @@ def show_hide_timeline(clickDataMap, _clickDataChart, _n_clicks):
         if clickDataMap is None:
             # clicked on empty map
             return {'display': 'none'}
+        elif helpers.is_cluster_click(clickDataMap):
+            return dash.no_update
         else:
             # clicked on data
             return {'display': 'block'}
@@ -114,8 +119,9 @@ def display_click_data(clickData, avg_checkbox, detail_radio, trace_visibility):
     prop_ids = helpers.dash_callback_get_prop_ids(ctx)
     if clickData is not None or "timeline-avg-check" in prop_ids:
         selection = ""
-        if detail_radio == "stations" and clickData["points"][0]['curveNumber'] == 0:
-            # exclude selection marker
+        if detail_radio == "stations" and (clickData["points"][0]['curveNumber'] == 0 or
+                                           helpers.is_cluster_click(clickData)):
+            # exclude selection marker and clusters of several stations
             return dash.no_update
         elif detail_radio == "landkreis":
             selection = clickData["points"][0]['location']
@@ -193,14 +199,14 @@ def update_from_url(urlbar_str):
      Input('nominatim_storage', 'data'),
      Input('mapposition_lookup_button', 'n_clicks')],
     [State('latlon_local_storage', 'data'),
-     State('map', 'figure'),
+     State('map_view_storage', 'data'),
      State("url", "search")]
 )
 def update_latlon_local_storage(urlbar_storage, clientside_callback_storage,
                                 nominatim_storage,
                                 _mapposition_lookup_button,
                                 latlon_local_storage,
-                                fig,
+                                map_view,
                                 urlbar_str):
     ctx = dash.callback_context
     if not ctx.triggered:
@@ -221,8 +227,10 @@ def update_latlon_local_storage(urlbar_storage, clientside_callback_storage,
             addr = nominatim_reverse_lookup(lat, lon)
             return lat, lon, addr
     elif prop_ids[0] == "mapposition_lookup_button":
-        lat = fig["layout"]["mapbox"]["center"]["lat"]
-        lon = fig["layout"]["mapbox"]["center"]["lon"]
+        # the map figure is not sent to the server, its view is stored by assets/map_figure.js
+        map_view = map_view or dict(lat=default_lat, lon=default_lon)
+        lat = map_view["lat"]
+        lon = map_view["lon"]
         addr = nominatim_reverse_lookup(lat, lon)
         return lat, lon, addr
     elif prop_ids[0] == "nominatim_storage" and nominatim_storage[2] != "":
@@ -279,7 +287,7 @@ def update_highlight(latlon_local_storage, radius, bundesland, landkreis, region
             addr = "..."
         location_text = f"{addr} ({radius}km Umkreis)"
         location_editbox = addr
-        filtered_map_data, poly = filter_by_radius(map_data, lat, lon, radius)
+        filtered_map_data, poly = filter_by_radius(ensure_geometry(map_data), lat, lon, radius)
 
         # highlight circle
         highlight_x, highlight_y = poly.exterior.coords.xy
@@ -309,12 +317,13 @@ def update_highlight(latlon_local_storage, radius, bundesland, landkreis, region
         mean_trend_str = "nicht verfügbar"
         location_text = ""
         location_editbox = nominatim_lookup_edit
-        highlight_polygon = (None, None)
+        highlight_polygon = (None, None, None)
         return mean_trend_str, location_text, location_editbox, highlight_polygon
 
     filtered_map_data = filtered_map_data[filtered_map_data["_measurement"].isin(trace_visibilty)]
     mean_trend = filtered_map_data["trend"].mean()
-    highlight_polygon = (highlight_x, highlight_y)
+    # view (zoom, center) to show the whole highlighted region
+    highlight_polygon = (highlight_x, highlight_y, helpers.calc_zoom(highlight_y, highlight_x))
     if np.isnan(mean_trend):
         mean_trend_str = "nicht verfügbar"
     else:
@@ -401,39 +410,52 @@ def update_trend_container_display(detail_radio, n_clicks):
             return {'display': 'none'}
 
 
+# Data of the map traces and geometries for the clientside assembly of the map figure.
+# The traces are loaded once per page view, the geometries when the zoom level needs
+# another tolerance. The tolerance is selected clientside, panning and zooming within
+# a tolerance does not send a request.
+# With static files, both are refreshed every trace_artifacts.URL_REFRESH_S seconds,
+# so that open pages only use URLs of current files.
 @app.callback(
-    Output('map', 'figure'),
+    Output('map_traces_storage', 'data'),
+    [Input('url', 'pathname'),
+     Input('map_artifacts_refresh_interval', 'n_intervals')])
+def update_map_traces_storage(_pathname, _n_intervals):
+    return get_map_client_data()
+
+
+app.clientside_callback(
+    ClientsideFunction(namespace="map_figure", function_name="geometry_tolerance"),
+    Output('map_geometry_tolerance', 'data'),
+    [Input('map_traces_storage', 'data'),
+     Input('map', 'relayoutData')],
+    [State('map_geometry_tolerance', 'data')])
+
+
+@app.callback(
+    Output('map_geometry_storage', 'data'),
+    [Input('map_geometry_tolerance', 'data'),
+     Input('map_artifacts_refresh_interval', 'n_intervals')])
+def update_map_geometry_storage(tolerance, _n_intervals):
+    return get_map_geometry(tolerance)
+
+
+# Redraw map based on level-of-detail selection, current highlight selection and
+# zoom level for the station clusters (clientside, see assets/map_figure.js).
+# map_artifacts_interval redraws it while static files are loaded in the background.
+app.clientside_callback(
+    ClientsideFunction(namespace="map_figure", function_name="update"),
+    [Output('map', 'figure'),
+     Output('map_view_storage', 'data'),
+     Output('map_artifacts_interval', 'disabled')],
     [Input('highlight_polygon', 'data'),
      Input('detail_radio', 'value'),
-     Input('trace_visibility_checklist', 'value')],
+     Input('trace_visibility_checklist', 'value'),
+     Input('map_traces_storage', 'data'),
+     Input('map_geometry_storage', 'data'),
+     Input('map', 'relayoutData'),
+     Input('map_artifacts_interval', 'n_intervals')],
     [State('map', 'figure')])
-def update_map(highlight_polygon, detail_radio, trace_visibilty, fig):
-    """
-    Redraw map based on level-of-detail selection and
-    current highlight selection
-    """
-    ctx = dash.callback_context
-    if not ctx.triggered:
-        return dash.no_update
-    prop_ids = helpers.dash_callback_get_prop_ids(ctx)
-    traces = get_map_traces(trace_visibilty)
-    fig["data"] = traces[detail_radio]  # Update map
-    if detail_radio == "stations":
-        if trace_visibilty:
-            highlight_x, highlight_y = highlight_polygon
-        else:
-            # hide when nothing is selected in trace_visibility
-            highlight_x, highlight_y = [], []
-        # draw highligth into trace0
-        fig["data"][0]["lat"] = highlight_y
-        fig["data"][0]["lon"] = highlight_x
-        if trace_visibilty and "highlight_polygon" in prop_ids:
-            # center and zoom map
-            zoom, centerlat, centerlon = helpers.calc_zoom(highlight_y, highlight_x)
-            fig["layout"]["mapbox"]["center"]["lat"] = centerlat
-            fig["layout"]["mapbox"]["center"]["lon"] = centerlon
-            fig["layout"]["mapbox"]["zoom"] = zoom
-    return fig
 
 
 @app.callback(
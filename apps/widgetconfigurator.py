@@ -15,7 +15,7 @@ with open("config.json", "r") as f:
 BASE_URL = CONFIG["BASE_URL"]
 MEASUREMENTS_WIDGET = CONFIG["measurements_widget"]
 
-map_data = get_map_data(MEASUREMENTS_WIDGET)
+map_data = get_map_data(MEASUREMENTS_WIDGET).copy()  # the cached object must not be modified
 map_data["ddname"] = map_data.apply(lambda x: f'{x["name"]} ({helpers.measurementtitles[x["_measurement"]]})', 1)
 if "city" in map_data.columns:
     map_data.loc[~map_data["city"].isna(), "ddname"] = map_data[~map_data["city"].isna()].apply(
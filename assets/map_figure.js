@@ -0,0 +1,351 @@
+/*
+Clientside assembly of the map figure (see the callbacks of the map in apps/dash_frontend.py)
+
+The station traces, the station clusters per zoom level and the partial trend sums
+per region are loaded once into the store "map_traces_storage", the region geometries
+into "map_geometry_storage". The tolerance of the geometries is selected here from
+the zoom level (geometry_tolerance), the server only sends geometries when it changes.
+The figure is built here from these stores and the small parts that change:
+highlight polygon, visible measurements, level of detail and zoom level.
+The view of the map (center and zoom) is also written to "map_view_storage", e.g.
+for the "center of map" location of the dashboard.
+Up to the zoom level cluster_zoom[1], the clusters of the current zoom level are
+shown instead of the single stations (see clusters.py). From the zoom level cull_zoom
+on, the clusters and stations are split into map tiles, only the tiles of the
+visible part of the map and a margin of VIEWPORT_PADDING around it are used. Tiles
+that were loaded once are kept, the map is only redrawn when other tiles are needed.
+The region tooltips are the same as helpers.region_tooltiptext().
+With MAP_ARTIFACT_DIR, the stores only contain the URLs of static files with the
+traces and geometries (see trace_artifacts.py). They are loaded when they are needed,
+once per URL, repeated page loads get them from the browser cache. The files are
+loaded in the background, while they are loading the interval "map_artifacts_interval"
+is enabled and the map is redrawn with the files that arrived. Files that cannot be
+loaded (e.g. deleted versions) are skipped until the stores are refreshed with the
+current URLs.
+*/
+
+var lastMapInputs = {};  // inputs of the previous call
+var lastMapView = null;  // {lat, lon, zoom} of the previous call
+var lastMapCorners;  // corners of the visible map from the last relayoutData of this view
+var lastRelayout;  // relayoutData of the previous call
+var mapArtifacts = {};  // URL -> parsed JSON
+var pendingArtifacts = {};  // URLs that are loading
+var failedArtifacts = {};  // URLs that could not be loaded
+var loadedArtifacts = 0;  // number of finished requests, the map is redrawn when it changes
+var lastLoadingDisabled = true;  // disabled prop of map_artifacts_interval
+var VIEWPORT_PADDING = 0.5;  // margin of the tiles around the visible map, in map widths and heights
+var DEFAULT_MAP_SIZE = [1600, 1000];  // pixels, if the bounds of the map are unknown
+
+function loadArtifact(url) {
+    // parsed JSON, or undefined while it is loaded in the background
+    // (the clientside callbacks of Dash cannot wait for a promise)
+    if (url in mapArtifacts) {
+        return mapArtifacts[url];
+    }
+    if (!(url in pendingArtifacts) && !(url in failedArtifacts)) {
+        pendingArtifacts[url] = true;
+        fetch(url).then(function (response) {
+            if (!response.ok) {
+                throw new Error(response.status + " " + response.statusText);
+            }
+            return response.json();
+        }).then(function (data) {
+            mapArtifacts[url] = data;
+        }).catch(function (error) {
+            failedArtifacts[url] = true;
+            console.warn("Map data " + url + " could not be loaded: " + error.message);
+        }).then(function () {
+            delete pendingArtifacts[url];
+            loadedArtifacts++;
+        });
+    }
+    return undefined;
+}
+
+function measurementEntry(traces, measurement, path) {
+    // inline data or URL of a measurement, path e.g. ["clusters", 6] or ["tiles", "stations", "135_86"]
+    var data = traces.artifacts ? traces.artifacts[measurement] : traces[path[0]] && traces[path[0]][measurement];
+    (traces.artifacts ? path : path.slice(1)).forEach(function (key) {
+        data = data && data[key];
+    });
+    return data || undefined;
+}
+
+function measurementData(traces, measurement, path) {
+    var data = measurementEntry(traces, measurement, path);
+    if (data && traces.artifacts) {
+        data = loadArtifact(data);
+    }
+    return data || undefined;
+}
+
+function mercator(lon, lat) {
+    // web mercator coordinates from 0 to 1, see clusters.mercator()
+    lat = Math.max(-85.0511, Math.min(85.0511, lat)) * Math.PI / 180;
+    return [(lon + 180) / 360, (1 - Math.log(Math.tan(lat) + 1 / Math.cos(lat)) / Math.PI) / 2];
+}
+
+function viewportTiles(mapbox, corners, tileZoom) {
+    // tiles "column_row" of the visible map and its margin
+    var points = (corners || []).map(function (x) {
+        return mercator(x[0], x[1]);
+    });
+    if (points.length === 0) {
+        // estimated from the center, e.g. when the map was just centered on a highlight
+        var center = mercator(mapbox.center.lon, mapbox.center.lat);
+        var scale = 512 * Math.pow(2, mapbox.zoom);
+        points = [[center[0] - DEFAULT_MAP_SIZE[0] / 2 / scale, center[1] - DEFAULT_MAP_SIZE[1] / 2 / scale],
+                  [center[0] + DEFAULT_MAP_SIZE[0] / 2 / scale, center[1] + DEFAULT_MAP_SIZE[1] / 2 / scale]];
+    }
+    var xs = points.map(function (p) { return p[0]; });
+    var ys = points.map(function (p) { return p[1]; });
+    var width = Math.max.apply(null, xs) - Math.min.apply(null, xs);
+    var height = Math.max.apply(null, ys) - Math.min.apply(null, ys);
+    var n = Math.pow(2, tileZoom);
+    var tiles = [];
+    for (var column = Math.floor((Math.min.apply(null, xs) - VIEWPORT_PADDING * width) * n);
+         column <= Math.floor((Math.max.apply(null, xs) + VIEWPORT_PADDING * width) * n); column++) {
+        for (var row = Math.floor((Math.min.apply(null, ys) - VIEWPORT_PADDING * height) * n);
+             row <= Math.floor((Math.max.apply(null, ys) + VIEWPORT_PADDING * height) * n); row++) {
+            tiles.push(column + "_" + row);
+        }
+    }
+    return tiles;
+}
+
+function mergeTraces(parts) {
+    // one trace of the tiles of a measurement
+    var merged = Object.assign({}, parts[0], {marker: Object.assign({}, parts[0].marker)});
+    ["lat", "lon", "text", "customdata"].forEach(function (key) {
+        merged[key] = [].concat.apply([], parts.map(function (x) { return x[key]; }));
+    });
+    ["color", "size"].forEach(function (key) {
+        if (Array.isArray(parts[0].marker[key])) {
+            merged.marker[key] = [].concat.apply([], parts.map(function (x) { return x.marker[key]; }));
+        }
+    });
+    return merged;
+}
+
+function stationTrace(traces, measurement, level, tiles) {
+    // stations or clusters of a measurement, culled to the tiles of the viewport
+    if (level !== undefined && (traces.cull_zoom === undefined || level < traces.cull_zoom)) {
+        return measurementData(traces, measurement, ["clusters", level]);
+    }
+    var key = level === undefined ? "stations" : level;
+    var index = measurementEntry(traces, measurement, ["tiles", key]);
+    if (!index) {
+        return measurementData(traces, measurement, ["stations"]);
+    }
+    var parts = tiles.filter(function (tile) {
+        return tile in index;
+    }).map(function (tile) {
+        return measurementData(traces, measurement, ["tiles", key, tile]);
+    }).filter(function (x) {
+        return x;
+    });
+    return parts.length > 0 ? mergeTraces(parts) : undefined;
+}
+
+function clusterLevel(traces, zoom) {
+    // zoom level of the clusters, undefined: single stations
+    if (!traces.cluster_zoom || zoom === undefined) {
+        return undefined;
+    }
+    var level = Math.max(traces.cluster_zoom[0], Math.floor(zoom));
+    return level <= traces.cluster_zoom[1] ? level : undefined;
+}
+
+function toleranceForZoom(zoomTolerances, zoom) {
+    // see geometry.tolerance_for_zoom()
+    if (zoom === undefined) {
+        return zoomTolerances[0][1];
+    }
+    for (var i = 0; i < zoomTolerances.length; i++) {
+        if (zoom <= zoomTolerances[i][0]) {
+            return zoomTolerances[i][1];
+        }
+    }
+    return 0;
+}
+
+function loadingOutput() {
+    // enable map_artifacts_interval while files are loading
+    var disabled = Object.keys(pendingArtifacts).length === 0;
+    if (disabled === lastLoadingDisabled) {
+        return window.dash_clientside.no_update;
+    }
+    lastLoadingDisabled = disabled;
+    return disabled;
+}
+
+function relayoutTriggered(relayout) {
+    // whether the user moved the map, i.e. relayoutData fired the callback: from the callback_context
+    // of the clientside callbacks (Dash >= 1.13), otherwise relayoutData is a new object
+    var context = window.dash_clientside.callback_context;
+    var triggered = context && context.triggered ? context.triggered.some(function (x) {
+        return x.prop_id === "map.relayoutData";
+    }) : relayout !== lastRelayout;
+    lastRelayout = relayout;
+    return triggered;
+}
+
+function formatTrendStr(trend) {
+    if (trend === null || isNaN(trend)) {
+        return '<i>nicht verfügbar</i>';
+    }
+    var trendStr = Math.round(100 * trend) + '%';
+    if (trend > 0) {
+        trendStr = '+' + trendStr;
+    }
+    return trendStr;
+}
+
+function regionTooltiptext(name, trend, size) {
+    return "<span style='font-size:1.5em'><b>" + name + "</b></span><br>" +
+        "<span style='font-size:0.85em; opacity:0.8;'>Messpunkte: " + size + "</span><br>" +
+        "<span style='font-size:1em'><b>Durchschnittlicher Trend:</b></span>" +
+        "<span style='font-size:1.5em'> " + formatTrendStr(trend) + "</span>" +
+        "<br><br><span style='font-size:0.85em; opacity:0.8;'>Anklicken um mehr Informationen zu erhalten!</span>";
+}
+
+function combineChoropleth(traces, geometry, visible) {
+    // mean trend per region from the partial sums of the visible measurements
+    var regions = {};
+    var order = [];
+    visible.forEach(function (measurement) {
+        var partials = measurementData(traces, measurement, ["regions"]);
+        if (!partials) {
+            return;
+        }
+        partials.ags.forEach(function (ags, i) {
+            if (!(ags in regions)) {
+                regions[ags] = {name: partials.name[i], sum: 0, count: 0, size: 0};
+                order.push(ags);
+            }
+            regions[ags].sum += partials.sum[i];
+            regions[ags].count += partials.count[i];
+            regions[ags].size += partials.size[i];
+        });
+    });
+    if (order.length === 0) {
+        return {type: "choroplethmapbox"};
+    }
+    var z = order.map(function (ags) {
+        var region = regions[ags];
+        return region.count > 0 ? region.sum / region.count : null;
+    });
+    return Object.assign({}, traces.choropleth, {
+        geojson: geometry,
+        locations: order,
+        z: z,
+        text: order.map(function (ags, i) {
+            return regionTooltiptext(regions[ags].name, z[i], regions[ags].size);
+        })
+    });
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    map_figure: {
+        update: function (highlight, detail, visible, traces, geometry, relayout, _nIntervals, figure) {
+            var noUpdate = window.dash_clientside.no_update;
+            if (!traces || !figure) {
+                return [noUpdate, noUpdate, noUpdate];
+            }
+            visible = visible || [];
+            var moved = relayoutTriggered(relayout);
+            relayout = relayout || {};
+            var inputs = {highlight: highlight, detail: detail, visible: visible, traces: traces, geometry: geometry};
+            var changed = Object.keys(inputs).filter(function (key) {
+                return inputs[key] !== lastMapInputs[key];
+            });
+            var highlightChanged = "highlight" in lastMapInputs && changed.indexOf("highlight") >= 0;
+            if (changed.indexOf("traces") >= 0 || changed.indexOf("geometry") >= 0) {
+                failedArtifacts = {};  // new URLs, or the same ones again after a refresh
+            }
+
+            var fig = Object.assign({}, figure);
+            fig.layout = Object.assign({}, figure.layout);
+            // the current view: the last one set here (the figure prop is not updated when only
+            // the view changed), or the one of the user if relayoutData fired the callback.
+            // relayoutData keeps the last move of the user, also after a highlight moved the map.
+            var mapbox = Object.assign({}, fig.layout.mapbox);
+            if (lastMapView) {
+                mapbox.zoom = lastMapView.zoom;
+                mapbox.center = {lat: lastMapView.lat, lon: lastMapView.lon};
+            }
+            var corners = lastMapCorners;
+            if (moved) {
+                if ("mapbox.zoom" in relayout) {
+                    mapbox.zoom = relayout["mapbox.zoom"];
+                }
+                if ("mapbox.center" in relayout) {
+                    mapbox.center = relayout["mapbox.center"];
+                }
+                corners = (relayout["mapbox._derived"] || {}).coordinates;
+            }
+            if (detail === "stations" && highlightChanged && visible.length > 0 && highlight && highlight[2]) {
+                // center and zoom map, view = [zoom, lat, lon] from helpers.calc_zoom()
+                var view = highlight[2];
+                mapbox.zoom = view[0];
+                mapbox.center = {lat: view[1], lon: view[2]};
+                corners = undefined;
+            }
+            fig.layout.mapbox = mapbox;
+            lastMapCorners = corners;
+            var mapView = {lat: mapbox.center.lat, lon: mapbox.center.lon, zoom: mapbox.zoom};
+            var viewOutput = noUpdate;
+            if (!lastMapView || ["lat", "lon", "zoom"].some(function (key) { return mapView[key] !== lastMapView[key]; })) {
+                viewOutput = lastMapView = mapView;
+            }
+            var level = detail === "stations" ? clusterLevel(traces, mapbox.zoom) : undefined;
+            var tiles = [];
+            if (detail === "stations" && (level === undefined || level >= traces.cull_zoom)) {
+                tiles = viewportTiles(mapbox, corners, traces.tile_zoom);
+            }
+            if (changed.length === 0 && level === lastMapInputs.level && tiles.join() === lastMapInputs.tiles &&
+                loadedArtifacts === lastMapInputs.loaded) {
+                // the map was only moved within the tiles or zoomed within a level, or no file arrived
+                return [noUpdate, viewOutput, loadingOutput()];
+            }
+            inputs.level = level;
+            inputs.tiles = tiles.join();
+            inputs.loaded = loadedArtifacts;
+            lastMapInputs = inputs;
+
+            if (detail === "stations") {
+                var x = [], y = [];
+                if (visible.length > 0 && highlight && highlight[0]) {
+                    x = highlight[0];
+                    y = highlight[1];
+                }
+                var data = [Object.assign({}, traces.radius, {lat: y, lon: x})];
+                visible.forEach(function (measurement) {
+                    var trace = stationTrace(traces, measurement, level, tiles);
+                    if (trace) {
+                        data.push(trace);
+                    }
+                });
+                fig.data = data;
+            } else {
+                if (geometry && geometry.url) {
+                    geometry = loadArtifact(geometry.url);
+                }
+                fig.data = [combineChoropleth(traces, geometry, visible)];
+            }
+            return [fig, viewOutput, loadingOutput()];
+        },
+
+        geometry_tolerance: function (traces, relayout, tolerance) {
+            if (!traces || !traces.zoom_tolerances) {
+                return window.dash_clientside.no_update;
+            }
+            relayout = relayout || {};
+            if (tolerance !== undefined && tolerance !== null && !("mapbox.zoom" in relayout)) {
+                return window.dash_clientside.no_update;  // e.g. the map was only moved
+            }
+            var newTolerance = toleranceForZoom(traces.zoom_tolerances, relayout["mapbox.zoom"]);
+            return newTolerance === tolerance ? window.dash_clientside.no_update : newTolerance;
+        }
+    }
+});
@@ -21,7 +21,29 @@
   "CACHE_THRESHOLD": 200,
   "CACHE_DEFAULT_TIMEOUT": 120
   },
+"INFLUX_TIMEOUT_S": 30,
+"INFLUX_RETRIES": 2,
+"INFLUX_MAX_WORKERS": 8,
+"INCREMENTAL_REFRESH": true,
+"FULL_REFRESH_INTERVAL_S": 86400,
+"TREND_AGGREGATE_WINDOW": "1h",
+"ROLLUP_BUCKETS": null,
+"TIMESERIES_DAYS": 90,
+"SAMPLING_INTERVALS": {"hystreet": "1h", "airquality": "1h"},
+"INFLUX_HOT_DAYS": 90,
+"ARCHIVE_DIR": null,
+"ARCHIVE_DAYS": 730,
+"LAST_VALUES_MAX_AGE_S": 120,
+"SLOW_CACHE_STALE_TIMEOUT": 86400,
+"MEMORY_CACHE_SIZE": 128,
+"LOCK_DIR": "locks",
+"ARROW_CACHE_DIR": "cache_arrow",
+"DATA_VERSION_INTERVAL_S": 30,
+"SNAPSHOT_DIR": "snapshots",
+"MAP_ARTIFACT_DIR": "map_artifacts",
 "AUTO_REFRESH_SLOW_CACHE_ENABLE": true,
+"WIDGET_HTTP_CACHE_ENABLE": true,
+"METRICS_ENABLE": true,
 "LOG_LEVEL": "DEBUG",
 "BASE_URL": "https://everyonecounts.de"
 }
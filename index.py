@@ -2,14 +2,17 @@ import json
 import logging
 import os
 from datetime import datetime
-from time import sleep
 import dash_core_components as dcc
 import dash_html_components as html
 from dash.dependencies import Input, Output
+from flask import Response
 
 from app import app
 from apps import widget, dash_frontend, widgetconfigurator
-from utils.cached_functions import get_map_data, get_map_traces
+from utils.cached_functions import get_map_data, get_map_client_data, get_map_geometry, get_station_version, \
+    map_artifacts, LAST_VALUES_MAX_AGE_S
+from utils.caching import start_refresher
+from utils import cache_metrics, http_cache
 
 # READ CONFIG
 # ============
@@ -17,15 +20,13 @@ with open("config.json", "r") as f:
     CONFIG = json.load(f)
 AUTO_REFRESH_SLOW_CACHE_ENABLE = CONFIG["AUTO_REFRESH_SLOW_CACHE_ENABLE"]
 AUTO_REFRESH_SLOW_CACHE_TIME_S = CONFIG["SLOW_CACHE_CONFIG"]["CACHE_DEFAULT_TIMEOUT"]
+METRICS_ENABLE = CONFIG.get("METRICS_ENABLE", True)
+WIDGET_HTTP_CACHE_ENABLE = CONFIG.get("WIDGET_HTTP_CACHE_ENABLE", True)
 
 # SETUP LAYOUT
 # ============
 app.layout = html.Div([
     dcc.Location(id='url', refresh=False),
-    dcc.Interval(id='periodic-callback',
-                 disabled=not AUTO_REFRESH_SLOW_CACHE_ENABLE,
-                 interval=AUTO_REFRESH_SLOW_CACHE_TIME_S*1000),  # milliseconds
-    html.Div(id='periodic-callback-dummy', style={"display": "none"}),
     html.Div(id='index-content'),
 ])
 
@@ -66,25 +67,40 @@ def display_page(pathname):
 
 # AUTO-REFRESH SLOW CACHE FUNCTIONS
 # =================================
-@app.callback(Output('periodic-callback-dummy', 'children'),
-              [Input('periodic-callback', 'n_intervals')])
-def auto_refresh_cached(n_intervals):
-    """
-    The interval component fires a callback that makes these calls to the
-    functions in the SLOW_CACHE. The result is that these expensive functions
-    are called periodically without user interaction. The sleep() delay ensures
-    that the functions are called a little bit after the cache expires. Thus, the
-    slow cache should always be populated and no user should ever need to have to
-    wait for the expensive functions to run.
-    Dash does not allow callbacks without an Output, that is why a dummy element
-    is required.
-    """
-    # sleep(10)
-    # logging.debug("Auto-refreshing slow cache...")
-    # get_map_data()
-    # get_map_traces()
-    # logging.debug(f"Auto-refresh {n_intervals} finished.")
-    return n_intervals
+# The slow cache functions return the previous value while they are refreshed in the
+# background. This thread calls them periodically, so that they are refreshed even
+# without any requests and no user ever has to wait for the expensive functions to run.
+# The map traces and geometries are also written to the static files (MAP_ARTIFACT_DIR).
+if AUTO_REFRESH_SLOW_CACHE_ENABLE:
+    start_refresher(AUTO_REFRESH_SLOW_CACHE_TIME_S, [get_map_data, get_map_client_data, get_map_geometry])
+
+
+# STATIC MAP FILES
+# ================
+# Content-hashed files of the map traces and geometries, cached by browsers for a year
+if map_artifacts is not None:
+    map_artifacts.init_app(app.server)
+
+
+# HTTP CACHING OF THE WIDGETS
+# ===========================
+# ETag and Cache-Control for the widget page, the widget callbacks run once per
+# widget and datapoint. The last values are refreshed every LAST_VALUES_MAX_AGE_S seconds.
+if WIDGET_HTTP_CACHE_ENABLE:
+    http_cache.WidgetHttpCache(
+        get_station_version,
+        max_age_s=LAST_VALUES_MAX_AGE_S,
+        code_version=http_cache.source_version(["apps", "assets", "utils"])
+    ).init_app(app.server)
+
+
+# CACHE METRICS
+# =============
+# Hits, misses and calculation times of the cached functions in the Prometheus text format
+if METRICS_ENABLE:
+    @app.server.route("/metrics")
+    def metrics():
+        return Response(cache_metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
 # MAIN
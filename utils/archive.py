@@ -0,0 +1,166 @@
+"""
+Local columnar archive of the raw station data for long timelines
+
+The InfluxDB keeps only the recent data hot (config: INFLUX_HOT_DAYS). Older
+datapoints are stored locally in Arrow IPC files, one file per measurement and month:
+    ARCHIVE_DIR/<measurement>/<YYYY-MM>.arrow
+with the columns _time (UTC), _id and _value, sorted by _id and _time.
+The files are opened as memory maps, so reading does not copy the columns.
+Only the rows that pass the filter are materialized when they are converted to pandas.
+
+The archive is filled with the same Flux query as queries.load_timeseries(). Run
+    python -m utils.archive
+e.g. as a monthly cronjob, to add all complete months that are still missing.
+pyarrow is an optional dependency. Without it the archive is disabled.
+"""
+
+import os
+import json
+import logging
+import pandas as pd
+from utils import queries, ingest, helpers
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.ipc
+except ImportError:
+    pa = None
+
+SUFFIX = ".arrow"
+
+
+def available():
+    return pa is not None
+
+
+def _schema():
+    return pa.schema([
+        ("_time", pa.timestamp("ns", tz="UTC")),
+        ("_id", pa.string()),
+        ("_value", pa.float64()),
+    ])
+
+
+def _months(start, stop):
+    # months (pandas Periods) that overlap [start, stop)
+    start = start.tz_convert("UTC").tz_localize(None)
+    stop = stop.tz_convert("UTC").tz_localize(None)
+    return pd.period_range(start.to_period("M"), stop.to_period("M"), freq="M")
+
+
+def _month_bounds(month):
+    # first and last (exclusive) timestamp of a month in UTC
+    return month.start_time.tz_localize("UTC"), (month + 1).start_time.tz_localize("UTC")
+
+
+class TimeseriesArchive:
+
+    def __init__(self, path):
+        """
+        :param str path: directory of the archive (config: ARCHIVE_DIR)
+        """
+        if not available():
+            raise ImportError("pyarrow is required for the timeseries archive")
+        self.path = path
+
+    def partition_path(self, measurement, month):
+        return os.path.join(self.path, measurement, f"{month.strftime('%Y-%m')}{SUFFIX}")
+
+    def archive_month(self, query_api, measurement, month, bucket="sdd"):
+        """
+        Request one month of raw data of a measurement from the InfluxDB and write it
+        to the archive. Months without data are stored as empty file.
+        """
+        start, stop = _month_bounds(month)
+        source_filter = f'r["_measurement"] == "{measurement}" and ' \
+                        f'r["_field"] == "{helpers.measurement2field(measurement)}"'
+        query = queries.raw_timeseries_flux(source_filter, queries.flux_time(start), queries.flux_time(stop), bucket)
+        df = ingest.query_frame(query_api, query, local_time=False)
+        if df.empty:
+            df = pd.DataFrame({"_time": pd.Series([], dtype="datetime64[ns, UTC]"), "_id": [], "_value": []})
+        df = df.astype({"_id": str, "_value": float}).sort_values(by=["_id", "_time"])
+        table = pa.Table.from_pandas(df[["_time", "_id", "_value"]], schema=_schema(), preserve_index=False)
+
+        path = self.partition_path(measurement, month)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with pa.OSFile(tmp_path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)  # readers never see a partial file
+        logging.debug(f"Archived {len(df)} datapoints of {measurement} for {month}")
+        return len(df)
+
+    def fill(self, query_api, measurements, start, bucket="sdd", overwrite=False):
+        """
+        Archive all complete months since start that are not in the archive yet
+
+        :param list measurements: measurements to archive
+        :param pandas.Timestamp start: timezone aware timestamp
+        :param bool overwrite: request months again that are in the archive already
+        """
+        now = pd.Timestamp.now(tz="UTC")
+        last_complete = now.tz_localize(None).to_period("M") - 1
+        for measurement in measurements:
+            for month in _months(start, now):
+                if month > last_complete:
+                    break
+                if overwrite or not os.path.exists(self.partition_path(measurement, month)):
+                    self.archive_month(query_api, measurement, month, bucket)
+
+    def _open(self, path):
+        # zero-copy: the table references the pages of the memory map
+        source = pa.memory_map(path, "r")
+        return pa.ipc.open_file(source).read_all()
+
+    def read(self, c_ids, start, stop):
+        """
+        Read the archived datapoints of the stations in c_ids in the range [start, stop)
+
+        :param list c_ids: compound indices
+        :param pandas.Timestamp start: timezone aware timestamp
+        :param pandas.Timestamp stop: timezone aware timestamp
+        :return pandas.DataFrame: columns _time (UTC), _value, _measurement and _id
+        """
+        ids_by_measurement = {}
+        for c_id in c_ids:
+            _measurement, _id = queries.split_compound_index(c_id)
+            ids_by_measurement.setdefault(_measurement, []).append(_id)
+        start_scalar = pa.scalar(start.tz_convert("UTC"), type=pa.timestamp("ns", tz="UTC"))
+        stop_scalar = pa.scalar(stop.tz_convert("UTC"), type=pa.timestamp("ns", tz="UTC"))
+        frames = []
+        for _measurement, _ids in ids_by_measurement.items():
+            value_set = pa.array(_ids, type=pa.string())
+            for month in _months(start, stop):
+                path = self.partition_path(_measurement, month)
+                if not os.path.exists(path):
+                    continue
+                table = self._open(path)
+                mask = pc.and_(
+                    pc.is_in(table["_id"], value_set=value_set),
+                    pc.and_(pc.greater_equal(table["_time"], start_scalar), pc.less(table["_time"], stop_scalar)))
+                table = table.filter(mask)
+                if table.num_rows == 0:
+                    continue
+                df = table.to_pandas()
+                df["_measurement"] = _measurement
+                frames.append(df)
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, ignore_index=True)
+
+
+if __name__ == '__main__':
+    """
+    Fill the archive with all complete months of the dashboard and widget measurements
+    """
+    with open("config.json", "r") as f:
+        CONFIG = json.load(f)
+    logging.basicConfig(level=CONFIG.get("LOG_LEVEL", "INFO"))
+    if not CONFIG.get("ARCHIVE_DIR"):
+        raise SystemExit("ARCHIVE_DIR is not configured")
+    archive = TimeseriesArchive(CONFIG["ARCHIVE_DIR"])
+    measurements = list(dict.fromkeys(CONFIG["measurements_dashboard"] + CONFIG["measurements_widget"]))
+    start = pd.Timestamp.now(tz="UTC") - pd.Timedelta(days=CONFIG.get("ARCHIVE_DAYS", 730))
+    archive.fill(queries.get_query_api_from_config(CONFIG), measurements, start)
@@ -0,0 +1,214 @@
+"""
+Metrics of the memoized functions (see caching.py)
+
+Every memoized function gets a FunctionMetrics object in REGISTRY with
+    - lookups by result: hit (fresh value), stale (value returned while it is
+      refreshed in the background), miss (the caller calculates the value) and
+      coalesced (a concurrent miss that waited for another caller)
+    - the number of values served from the in-process memory tier
+    - histograms of the time to calculate a value, inline (miss) and in the background (refresh)
+    - failed calculations
+    - number and size of the live entries stored by this process: an entry is dropped
+      when it expires or when the cache does not have it anymore (evicted or invalidated,
+      these are counted as evictions if they happen before the expiry)
+    - number of entries in and evictions from the memory tier
+render() returns all metrics in the Prometheus text format, it is served at /metrics (see index.py).
+"""
+
+import os
+import sys
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+LATENCY_BUCKETS_S = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+LOOKUP_RESULTS = ("hit", "stale", "miss", "coalesced")
+CALCULATIONS = ("miss", "refresh")
+
+
+def entry_size(value):
+    """
+    Size of a stored value in bytes, without serializing it again: the file size of
+    values from the ArrowSerializer, otherwise the deep size in memory (DataFrames with
+    the contents of their object columns, containers with all their items, objects
+    that are referenced several times are counted once like in a pickle)
+    """
+    size = 0
+    seen = set()
+    stack = [value]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if hasattr(obj, "path") and not isinstance(obj, dict):  # cache_serializers.ArrowFrameRef
+            try:
+                size += os.path.getsize(obj.path)
+            except OSError:
+                pass
+        elif isinstance(obj, (pd.DataFrame, pd.Series)):
+            size += int(np.sum(obj.memory_usage(index=True, deep=True)))
+        elif isinstance(obj, np.ndarray):
+            size += obj.nbytes
+        else:
+            size += sys.getsizeof(obj)
+            if isinstance(obj, dict):
+                stack.extend(obj.keys())
+                stack.extend(obj.values())
+            elif isinstance(obj, (list, tuple, set, frozenset)):
+                stack.extend(obj)
+            elif hasattr(obj, "__dict__"):
+                stack.append(obj.__dict__)
+    return size
+
+
+class Histogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS_S):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)  # not cumulative
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class FunctionMetrics:
+
+    def __init__(self, name):
+        self.name = name
+        self.lookups = dict.fromkeys(LOOKUP_RESULTS, 0)
+        self.memory_hits = 0
+        self.errors = dict.fromkeys(CALCULATIONS, 0)
+        self.latency = {x: Histogram() for x in CALCULATIONS}
+        self.entries = {}  # cache key -> (size in bytes, expiry time) of the entries stored by this process
+        self.evictions = 0  # entries that were gone before their expiry
+        self.memory = None  # caching.MemoryLRU of the function, for the evictions
+        self._lock = threading.Lock()
+
+    def lookup(self, result):
+        with self._lock:
+            self.lookups[result] += 1
+
+    def memory_hit(self):
+        with self._lock:
+            self.memory_hits += 1
+
+    def calculated(self, calculation, duration_s, failed=False):
+        with self._lock:
+            self.latency[calculation].observe(duration_s)
+            if failed:
+                self.errors[calculation] += 1
+
+    def stored(self, key, value, timeout):
+        size = entry_size(value)
+        with self._lock:
+            self.entries[key] = (size, time.time() + timeout)
+
+    def missing(self, key):
+        # the cache has no (readable) entry for key
+        with self._lock:
+            item = self.entries.pop(key, None)
+            if item is not None and item[1] > time.time():
+                self.evictions += 1
+
+    def live_entries(self):
+        """
+        Sizes of the entries stored by this process that are not expired
+        """
+        now = time.time()
+        with self._lock:
+            for key in [k for k, (_, expires) in self.entries.items() if expires <= now]:
+                del self.entries[key]
+            return [size for size, _ in self.entries.values()]
+
+
+REGISTRY = {}  # function name -> FunctionMetrics
+_registry_lock = threading.Lock()
+
+
+def metrics_for(name):
+    with _registry_lock:
+        return REGISTRY.setdefault(name, FunctionMetrics(name))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render():
+    """
+    All metrics in the Prometheus text exposition format
+    """
+    lines = []
+
+    def family(name, kind, description):
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+
+    def sample(name, labels, value):
+        label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+        lines.append(f"{name}{{{label_text}}} {value}")
+
+    with _registry_lock:
+        functions = sorted(REGISTRY.values(), key=lambda x: x.name)
+
+    family("cache_lookups_total", "counter", "Calls of memoized functions by result")
+    for m in functions:
+        for result, count in m.lookups.items():
+            sample("cache_lookups_total", dict(function=m.name, result=result), count)
+
+    family("cache_memory_hits_total", "counter", "Values served from the in-process memory tier")
+    for m in functions:
+        sample("cache_memory_hits_total", dict(function=m.name), m.memory_hits)
+
+    family("cache_calculation_errors_total", "counter", "Failed calculations of memoized functions")
+    for m in functions:
+        for calculation, count in m.errors.items():
+            sample("cache_calculation_errors_total", dict(function=m.name, calculation=calculation), count)
+
+    family("cache_calculation_seconds", "histogram",
+           "Time to calculate a value, inline on a miss or in a background refresh")
+    for m in functions:
+        for calculation, histogram in m.latency.items():
+            labels = dict(function=m.name, calculation=calculation)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                sample("cache_calculation_seconds_bucket", dict(labels, le=bound), cumulative)
+            sample("cache_calculation_seconds_bucket", dict(labels, le="+Inf"), histogram.count)
+            sample("cache_calculation_seconds_sum", labels, round(histogram.sum, 6))
+            sample("cache_calculation_seconds_count", labels, histogram.count)
+
+    sizes = {m.name: m.live_entries() for m in functions}
+    family("cache_entries", "gauge", "Number of live entries stored by this process")
+    for m in functions:
+        sample("cache_entries", dict(function=m.name), len(sizes[m.name]))
+
+    family("cache_entry_bytes", "gauge", "Total size of the live entries stored by this process")
+    for m in functions:
+        sample("cache_entry_bytes", dict(function=m.name), sum(sizes[m.name]))
+
+    family("cache_evictions_total", "counter",
+           "Entries stored by this process that were evicted or invalidated before their expiry")
+    for m in functions:
+        sample("cache_evictions_total", dict(function=m.name), m.evictions)
+
+    family("cache_memory_entries", "gauge", "Number of entries in the in-process memory tier")
+    for m in functions:
+        if m.memory is not None:
+            sample("cache_memory_entries", dict(function=m.name), len(m.memory.items))
+
+    family("cache_memory_evictions_total", "counter", "Entries evicted from the in-process memory tier")
+    for m in functions:
+        if m.memory is not None:
+            sample("cache_memory_evictions_total", dict(function=m.name), m.memory.evictions)
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,170 @@
+"""
+Serializers for the values of caching.memoize()
+
+By default, the cache backend pickles the values. ArrowSerializer stores DataFrames
+as Arrow IPC files instead and only a small reference goes into the cache:
+    - writing is much faster than pickling shapely geometries: the geometry
+      of a GeoDataFrame is dropped, it is rebuilt from the lat/lon columns when
+      it is needed (see ensure_geometry())
+    - the files are read through a memory map, numeric columns are not copied
+Every cache key has one file per version. A version is deleted GRACE_PERIOD_S after
+it was replaced by a newer one, so that references that were read from the cache
+just before the replacement can still be loaded. With max_age_s (the longest timeout
+of the cache entries), the last version of a key is deleted when its entry has expired.
+The whole directory is checked every SWEEP_INTERVAL_S, also for keys that are not
+written anymore.
+Other values (e.g. the dicts of map traces) are passed through unchanged.
+"""
+
+import glob
+import hashlib
+import logging
+import os
+import time
+import uuid
+import pandas as pd
+import geopandas as gpd
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:
+    pa = None
+
+GRACE_PERIOD_S = 600
+SWEEP_INTERVAL_S = 600
+
+
+def available():
+    return pa is not None
+
+
+def ensure_geometry(df):
+    """
+    Return df as GeoDataFrame. The geometry is built from the lat/lon columns if
+    df is a plain DataFrame, e.g. map data from the ArrowSerializer
+    """
+    if isinstance(df, gpd.GeoDataFrame):
+        return df
+    return gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df["lon"], df["lat"]))
+
+
+def frame_to_table(df, key=""):
+    """
+    Arrow table of a DataFrame without the geometry column, None if Arrow cannot store it
+    """
+    if isinstance(df, gpd.GeoDataFrame):
+        df = pd.DataFrame(df.drop(columns=df.geometry.name))
+    try:
+        return pa.Table.from_pandas(df)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+        logging.warning(f"Arrow serialization of {key} failed, pickling it instead: {e}")
+        return None
+
+
+def table_to_frame(table):
+    # one block per column, so that numeric columns are views of the Arrow buffers
+    return table.to_pandas(split_blocks=True)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass  # removed by another process
+
+
+class ArrowFrameRef:
+    """
+    Reference to a DataFrame in an Arrow IPC file, stored in the cache instead of the DataFrame
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+
+class ArrowSerializer:
+
+    def __init__(self, directory, max_age_s=None):
+        """
+        :param str directory: directory for the Arrow files
+        :param int max_age_s: number of seconds after which the cache entries expire, None to keep
+            the last version of every key
+        """
+        if not available():
+            raise ImportError("pyarrow is required for the ArrowSerializer")
+        self.directory = directory
+        self.max_age_s = max_age_s
+        self._last_sweep = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def dumps(self, key, value):
+        if not isinstance(value, pd.DataFrame):
+            return value
+        table = frame_to_table(value, key)
+        if table is None:
+            return value
+        prefix = os.path.join(self.directory, hashlib.md5(key.encode()).hexdigest())
+        path = f"{prefix}-{uuid.uuid4().hex}.arrow"
+        tmp_path = path + ".tmp"
+        with pa.OSFile(tmp_path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+        if time.monotonic() - self._last_sweep > SWEEP_INTERVAL_S:
+            self._last_sweep = time.monotonic()
+            self.sweep()
+        else:
+            self._remove_outdated(glob.glob(f"{prefix}-*.arrow"))
+        return ArrowFrameRef(path)
+
+    def sweep(self):
+        """
+        Delete the outdated files of all keys, and temporary files of interrupted writes
+        """
+        files = {}  # prefix -> paths
+        for path in glob.glob(os.path.join(self.directory, "*-*.arrow")):
+            files.setdefault(path.rsplit("-", 1)[0], []).append(path)
+        for paths in files.values():
+            self._remove_outdated(paths)
+        self._remove_older(glob.glob(os.path.join(self.directory, "*.arrow.tmp")), GRACE_PERIOD_S)
+
+    def _remove_outdated(self, paths):
+        # a version was replaced when the next newer one was written
+        versions = []
+        for path in paths:
+            try:
+                versions.append((os.path.getmtime(path), path))
+            except FileNotFoundError:
+                pass  # removed by another process
+        versions.sort()
+        now = time.time()
+        for (_, path), (replaced, _) in zip(versions, versions[1:]):
+            if replaced < now - GRACE_PERIOD_S:
+                _remove(path)
+        if self.max_age_s is not None and versions:
+            # the cache entry of the last version is written together with its file
+            written, path = versions[-1]
+            if written < now - self.max_age_s - GRACE_PERIOD_S:
+                _remove(path)
+
+    @staticmethod
+    def _remove_older(paths, age_s):
+        for path in paths:
+            try:
+                if os.path.getmtime(path) < time.time() - age_s:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass  # removed by another process
+
+    def loads(self, stored):
+        """
+        Return the value, or None if the file of the reference was deleted in the meantime
+        """
+        if not isinstance(stored, ArrowFrameRef):
+            return stored
+        try:
+            source = pa.memory_map(stored.path, "r")
+        except FileNotFoundError:
+            return None
+        return table_to_frame(pa.ipc.open_file(source).read_all())
@@ -8,48 +8,262 @@ yields "RuntimeError: Working outside of request context."
 
 import logging
 import json
-from utils import queries, map_traces
+from utils import queries, map_traces, geometry, archive, caching, cache_serializers, trace_artifacts
+from utils.map_snapshot import MapDataSnapshot
+from utils.last_values import LastValueTable
 from app import slow_cache, fast_cache
 
 with open("config.json", "r") as f:
     CONFIG = json.load(f)
 
 DISABLE_CACHE = not CONFIG["ENABLE_CACHE"]  # set to true to disable caching
+SLOW_CACHE_TIMEOUT = CONFIG["SLOW_CACHE_CONFIG"]["CACHE_DEFAULT_TIMEOUT"]
+SLOW_CACHE_STALE_TIMEOUT = CONFIG.get("SLOW_CACHE_STALE_TIMEOUT", 86400)
+FAST_CACHE_TIMEOUT = CONFIG["FAST_CACHE_CONFIG"]["CACHE_DEFAULT_TIMEOUT"]
+MEMORY_CACHE_SIZE = CONFIG.get("MEMORY_CACHE_SIZE", 128)
+LOCK_DIR = CONFIG.get("LOCK_DIR", "locks")
+ARROW_CACHE_DIR = CONFIG.get("ARROW_CACHE_DIR")
 TRENDWINDOW = CONFIG["TRENDWINDOW"]
 MEASUREMENTS_DASHBOARD = CONFIG["measurements_dashboard"]
+MEASUREMENTS_WIDGET = CONFIG["measurements_widget"]
+INCREMENTAL_REFRESH = CONFIG.get("INCREMENTAL_REFRESH", True)
+FULL_REFRESH_INTERVAL_S = CONFIG.get("FULL_REFRESH_INTERVAL_S", 86400)
+TREND_AGGREGATE_WINDOW = CONFIG.get("TREND_AGGREGATE_WINDOW")
+ROLLUP_BUCKETS = CONFIG.get("ROLLUP_BUCKETS")
+TIMESERIES_DAYS = CONFIG.get("TIMESERIES_DAYS", 90)
+SAMPLING_INTERVALS = CONFIG.get("SAMPLING_INTERVALS")
+INFLUX_HOT_DAYS = CONFIG.get("INFLUX_HOT_DAYS", 90)
+ARCHIVE_DIR = CONFIG.get("ARCHIVE_DIR")
+LAST_VALUES_MAX_AGE_S = CONFIG.get("LAST_VALUES_MAX_AGE_S", 120)
+SNAPSHOT_DIR = CONFIG.get("SNAPSHOT_DIR", "snapshots")
+MAP_ARTIFACT_DIR = CONFIG.get("MAP_ARTIFACT_DIR", "map_artifacts")
+DATA_VERSION_INTERVAL_S = CONFIG.get("DATA_VERSION_INTERVAL_S", 30)
 
 query_api = queries.get_query_api_from_config(CONFIG)
+single_flight = caching.SingleFlight(LOCK_DIR)  # concurrent cache misses wait for a single calculation
+frame_serializer = None  # DataFrames are pickled by the cache backend
+if ARROW_CACHE_DIR:
+    if cache_serializers.available():
+        frame_serializer = cache_serializers.ArrowSerializer(
+            ARROW_CACHE_DIR, max_age_s=max(SLOW_CACHE_STALE_TIMEOUT, FAST_CACHE_TIMEOUT))
+    else:
+        logging.warning("ARROW_CACHE_DIR is set but pyarrow is not installed, cached DataFrames are pickled")
+# last good map data and traces on disk, used at startup instead of waiting for the InfluxDB
+persisted_snapshots = caching.PersistentStore(SNAPSHOT_DIR) if SNAPSHOT_DIR else None
+# map traces and geometries as static files with content-hashed names, see trace_artifacts.py
+map_artifacts = trace_artifacts.ArtifactStore(MAP_ARTIFACT_DIR) if MAP_ARTIFACT_DIR else None
+map_data_snapshots = {}  # tuple of measurements -> MapDataSnapshot
+LAST_VALUE_MEASUREMENTS = list(dict.fromkeys(MEASUREMENTS_WIDGET + MEASUREMENTS_DASHBOARD))
+timeseries_archive = None
+if ARCHIVE_DIR:
+    if archive.available():
+        timeseries_archive = archive.TimeseriesArchive(ARCHIVE_DIR)
+    else:
+        logging.warning("ARCHIVE_DIR is set but pyarrow is not installed, the archive is not used")
+
+
+# DATA VERSIONS
+# -------------
+# The time of the newest datapoint of every measurement is requested every
+# DATA_VERSION_INTERVAL_S seconds in a background thread (through the fast cache,
+# so the processes share the result). Cache entries are reused until it changes,
+# the cache timeouts are only an upper bound for their age (see caching.py).
+# Requests never wait for the InfluxDB here: until the first answer and while the
+# InfluxDB is not available, the versions are unknown and entries are only outdated by age.
+
+@caching.memoize(fast_cache, DATA_VERSION_INTERVAL_S, memory_size=1, single_flight=single_flight,
+                 unless=DISABLE_CACHE)
+def load_data_versions():
+    logging.debug("FAST CACHE MISS, load_data_versions")
+    return queries.load_data_versions(query_api, LAST_VALUE_MEASUREMENTS)
+
+
+data_versions = caching.PeriodicValue(load_data_versions, DATA_VERSION_INTERVAL_S) if DATA_VERSION_INTERVAL_S else None
+
+
+def get_data_version(measurements):
+    versions = data_versions.get() if data_versions is not None else None
+    if versions is None:
+        return None  # unknown
+    return tuple(versions.get(x) for x in measurements)
+
+
+def data_version(f):
+    # data_version for caching.memoize(), None if the data versions are disabled
+    return f if DATA_VERSION_INTERVAL_S else None
 
 
 # FUNCTIONS USING THE SLOW CACHE
 # ------------------------------
+# After SLOW_CACHE_TIMEOUT, the previous value is still returned while the new one
+# is calculated in the background (stale-while-revalidate, see caching.py).
+# The last values are saved in SNAPSHOT_DIR, so that a restart does not wait for the InfluxDB.
 
-@slow_cache.memoize(unless=DISABLE_CACHE)
+@caching.memoize(slow_cache, SLOW_CACHE_TIMEOUT, stale_timeout=SLOW_CACHE_STALE_TIMEOUT,
+                 memory_size=MEMORY_CACHE_SIZE, single_flight=single_flight, serializer=frame_serializer,
+                 persist=persisted_snapshots,
+                 data_version=data_version(lambda measurements=MEASUREMENTS_DASHBOARD: get_data_version(measurements)),
+                 unless=DISABLE_CACHE)
 def get_map_data(measurements=MEASUREMENTS_DASHBOARD):
     logging.debug("SLOW CACHE MISS, get_map_data")
-    return queries.get_map_data(
-        query_api=query_api,
-        measurements=measurements,
-        trend_window=TRENDWINDOW)
+    if not INCREMENTAL_REFRESH or not measurements:
+        return queries.get_map_data(
+            query_api=query_api,
+            measurements=measurements,
+            trend_window=TRENDWINDOW,
+            aggregate_every=TREND_AGGREGATE_WINDOW)
+    # keep the previous data and request only what is new since the last refresh
+    snapshot = map_data_snapshots.setdefault(
+        tuple(measurements),
+        MapDataSnapshot(measurements, TRENDWINDOW, full_refresh_interval_s=FULL_REFRESH_INTERVAL_S,
+                        aggregate_every=TREND_AGGREGATE_WINDOW))
+    return snapshot.refresh(query_api)
+
+
+def map_data_version(measurement):
+    """
+    Data version of a measurement in the current get_map_data entry. It only changes when
+    get_map_data was refreshed with new data of this measurement, the fragments of the other
+    measurements are kept.
+    """
+    versions = get_map_data.cached_data_version()
+    if versions is None or measurement not in MEASUREMENTS_DASHBOARD:
+        return get_map_data.cached_version()
+    return versions[MEASUREMENTS_DASHBOARD.index(measurement)]
+
+
+@caching.memoize(slow_cache, SLOW_CACHE_TIMEOUT, stale_timeout=SLOW_CACHE_STALE_TIMEOUT,
+                 memory_size=MEMORY_CACHE_SIZE, single_flight=single_flight, persist=persisted_snapshots,
+                 data_version=data_version(map_data_version),
+                 unless=DISABLE_CACHE)
+def get_map_trace_fragment(measurement):
+    logging.debug(f"SLOW CACHE MISS, get_map_trace_fragment ({measurement})")
+    return map_traces.get_trace_fragment(get_map_data(), measurement)
+
+
+def get_map_traces(measurements=MEASUREMENTS_DASHBOARD, zoom=None):
+    """
+    Map traces for any selection of the dashboard measurements, assembled from
+    the cached fragments of the single measurements (see map_traces.py)
+    """
+    return map_traces.assemble_map_traces([get_map_trace_fragment(x) for x in measurements], zoom=zoom)
+
 
+def get_map_client_data(measurements=MEASUREMENTS_DASHBOARD):
+    """
+    Map traces of all measurements for the clientside assembly of the map figure.
+    With MAP_ARTIFACT_DIR, the traces of every measurement are a static file and
+    only their URLs are returned.
+    """
+    fragments = [get_map_trace_fragment(x) for x in measurements]
+    if map_artifacts is None:
+        return map_traces.client_data(fragments, measurements)
+    # the files are written again when the cached fragment was refreshed
+    artifacts = {m: publish_client_fragment(m, x) for m, x in zip(measurements, fragments)}
+    return dict(artifacts=artifacts, **map_traces.client_settings())
 
-@slow_cache.memoize(unless=DISABLE_CACHE)
-def get_map_traces(measurements=MEASUREMENTS_DASHBOARD):
-    logging.debug("SLOW CACHE MISS, get_map_traces")
-    map_data = get_map_data(measurements)
-    return map_traces.get_map_traces(map_data, measurements)
+
+def publish_client_fragment(measurement, fragment):
+    """
+    URLs of the files with the regions, clusters and tiles of a measurement,
+    the browser only loads the clusters of the current zoom level and the visible tiles
+    """
+    version = get_map_trace_fragment.cached_version(measurement)
+    client_fragment = map_traces.client_fragment(fragment)
+    return dict(
+        regions=map_artifacts.publish(f"regions-{measurement}", client_fragment["regions"], version=version),
+        clusters={level: map_artifacts.publish(f"clusters-{measurement}-{level}", trace, version=version)
+                  for level, trace in client_fragment["clusters"].items()},
+        tiles={level: {tile: map_artifacts.publish(f"tile-{measurement}-{level}-{tile}", trace, version=version)
+                       for tile, trace in tiles.items()}
+               for level, tiles in client_fragment["tiles"].items()})
+
+
+def get_map_geometry(tolerance=None, region="landkreis"):
+    """
+    GeoJSON of the regions with stations, simplified with the tolerance (see geometry.py,
+    None: the tolerance of the whole country). The browser selects the tolerance for its
+    zoom level (see assets/map_figure.js).
+    With MAP_ARTIFACT_DIR, {"url": URL of the static file} instead.
+    """
+    if tolerance is None:
+        tolerance = geometry.tolerance_for_zoom(None)
+    map_data = get_map_data()
+    if map_artifacts is None:
+        return geometry.region_geojson(region, map_data["ags"].dropna(), tolerance=tolerance)
+    map_data_version = get_map_data.cached_version()
+    url = map_artifacts.publish(
+        f"geometry-{region}-{tolerance}",
+        lambda: geometry.region_geojson(region, map_data["ags"].dropna(), tolerance=tolerance),
+        version=None if map_data_version is None else (map_data_version, tolerance))
+    return dict(url=url)
 
 
 # FUNCTIONS USING THE FAST CACHE
 # ------------------------------
 
-@fast_cache.memoize(unless=DISABLE_CACHE)
+def measurement_version(c_id, _field=None):
+    return get_data_version([queries.split_compound_index(c_id)[0]])
+
+
+@caching.memoize(fast_cache, FAST_CACHE_TIMEOUT, memory_size=MEMORY_CACHE_SIZE, single_flight=single_flight,
+                 serializer=frame_serializer, data_version=data_version(measurement_version), unless=DISABLE_CACHE)
 def load_timeseries(_id):
     logging.debug(f"FAST CACHE MISS ({_id})")
-    return queries.load_timeseries(query_api, _id)
+    return queries.load_timeseries(query_api, _id, daysback=TIMESERIES_DAYS, rollup_buckets=ROLLUP_BUCKETS,
+                                   archive=timeseries_archive, hot_days=INFLUX_HOT_DAYS,
+                                   sampling_intervals=SAMPLING_INTERVALS)
+
+
+def load_timeseries_many(c_ids):
+    """
+    Cached counterpart of queries.load_timeseries_many()
+    Stations that are in the fast cache already are taken from there. All other
+    stations are loaded with a single query and stored in the cache entries of
+    load_timeseries() so that later calls for single stations are cache hits.
+    """
+    def load_missing(missing):
+        logging.debug(f"FAST CACHE MISS ({missing})")
+        return queries.load_timeseries_many(query_api, missing, daysback=TIMESERIES_DAYS,
+                                            rollup_buckets=ROLLUP_BUCKETS,
+                                            archive=timeseries_archive, hot_days=INFLUX_HOT_DAYS,
+                                            sampling_intervals=SAMPLING_INTERVALS)
+
+    return load_timeseries.get_many(c_ids, load_missing)
+
+
+@caching.memoize(fast_cache, LAST_VALUES_MAX_AGE_S, stale_timeout=SLOW_CACHE_STALE_TIMEOUT,
+                 memory_size=MEMORY_CACHE_SIZE, single_flight=single_flight, serializer=frame_serializer,
+                 data_version=data_version(lambda: get_data_version(LAST_VALUE_MEASUREMENTS)), unless=DISABLE_CACHE)
+def load_last_values():
+    logging.debug("FAST CACHE MISS, load_last_values")
+    return queries.load_last_values(query_api, LAST_VALUE_MEASUREMENTS)
+
+
+last_values = LastValueTable(LAST_VALUE_MEASUREMENTS, load_last_values)
 
 
-@fast_cache.memoize(unless=DISABLE_CACHE)
 def load_last_datapoint(c_id, _field=None):
+    """
+    Last datapoint of a station from the table of all stations (see last_values.py).
+    Stations of other measurements are requested one by one.
+    """
+    if last_values.covers(c_id):
+        return last_values.lookup(c_id, _field)
+    return load_last_datapoint_single(c_id, _field)
+
+
+def get_station_version(c_id):
+    """
+    Time of the last datapoint and "open" state of a station, changes with every new datapoint
+    (used for the HTTP caching of the widgets, see http_cache.py)
+    """
+    times = [load_last_datapoint(c_id, _field) for _field in (None, "open")]
+    return tuple(str(x["_time"].iloc[0]) if not x.empty else None for x in times)
+
+
+@caching.memoize(fast_cache, FAST_CACHE_TIMEOUT, memory_size=MEMORY_CACHE_SIZE, single_flight=single_flight,
+                 data_version=data_version(measurement_version), unless=DISABLE_CACHE)
+def load_last_datapoint_single(c_id, _field=None):
     logging.debug(f"FAST CACHE MISS ({c_id})")
     return queries.load_last_datapoint(query_api, c_id, _field=_field)
@@ -0,0 +1,603 @@
+"""
+Memoization of the expensive functions in cached_functions.py
+
+memoize() stores the results in a Flask-Caching cache like Cache.memoize(), but
+with stale-while-revalidate semantics:
+    - younger than timeout: the cached value is returned
+    - older than timeout: the cached value is still returned, and a single
+      background thread calculates the new value (only one per key, also across
+      processes that share the cache)
+    - older than stale_timeout: the value is dropped by the cache, the next call
+      calculates it inline
+Thus, only the very first call (or a call after a long time without any
+requests) has to wait for the function.
+
+With memory_size, the deserialized values are also kept in a bounded in-process
+LRU in front of the Flask-Caching store. Every cache entry has a version that is
+stored separately in the shared cache. A value from the memory tier is used as long
+as its version matches, so other processes pick up refreshed entries. The version is
+checked at most every VERSION_CHECK_INTERVAL_S seconds.
+Values from the memory tier are shared by all callers and must not be modified.
+
+With single_flight, concurrent cache misses for the same key are coalesced: one
+caller calculates the value, the others wait for it and read it from the cache.
+This works across threads and, with a lock directory, across processes (fcntl
+file locks, not available on Windows).
+
+With persist, the last value of every key is also saved to disk, in a background
+thread and with DataFrames as Arrow data (see PersistentStore). After a restart
+(with an empty or cleared cache), the saved value is returned at once instead of
+waiting for the function, and it is refreshed in the background like any other
+stale value. If the refresh fails, e.g. because the InfluxDB is down, the saved
+value is served until a refresh succeeds.
+
+With data_version, every entry also records the version of the data it was
+calculated from, e.g. the time of the last datapoint of the measurements. When the
+current version differs, the entry is outdated regardless of its age: it is
+recalculated inline, or with stale_timeout in the background. Then timeout is only
+an upper bound for the age, entries are reused as long as there is no new data.
+The version is only determined when an entry was found or has to be calculated. It
+should be cheap, e.g. the last result of a PeriodicValue.
+
+Hits, misses, calculation times and entry sizes of every memoized function are
+recorded in cache_metrics.py.
+"""
+
+import functools
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from utils import cache_metrics, cache_serializers
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+REFRESH_LOCK_TIMEOUT_S = 600  # a background refresh that takes longer is assumed to be dead
+VERSION_CHECK_INTERVAL_S = 5
+SINGLE_FLIGHT_TIMEOUT_S = 120  # waiting for a calculation that takes longer, the caller calculates itself
+
+
+class CacheEntry:
+    """
+    Value of a memoized function call together with the time of its calculation
+    """
+
+    def __init__(self, value, created=None, data_version=None):
+        self.value = value
+        self.created = time.time() if created is None else created
+        self.version = uuid.uuid4().hex
+        self.data_version = data_version
+
+    def age(self):
+        return time.time() - self.created
+
+    def with_value(self, value):
+        # same entry (time and version) with another representation of the value
+        entry = CacheEntry(value, self.created, getattr(self, "data_version", None))
+        entry.version = self.version
+        return entry
+
+    def outdated(self, data_version):
+        # None: the version is unknown, the entry is only outdated by age
+        return data_version is not None and getattr(self, "data_version", None) != data_version
+
+
+class MemoryLRU:
+    """
+    Bounded in-process LRU of deserialized cache entries
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self.items.get(key)
+            if item is not None:
+                self.items.move_to_end(key)
+            return item
+
+    def put(self, key, item):
+        with self._lock:
+            self.items[key] = item
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            return self.items.pop(key, None)
+
+
+class SingleFlight:
+    """
+    Per-key locks for threads and (with lock_dir) processes
+    """
+
+    def __init__(self, lock_dir=None, timeout_s=SINGLE_FLIGHT_TIMEOUT_S):
+        self.lock_dir = lock_dir if fcntl is not None else None
+        self.timeout_s = timeout_s
+        self._locks = {}  # key -> [threading.Lock, number of users]
+        self._lock = threading.Lock()
+        if self.lock_dir:
+            os.makedirs(self.lock_dir, exist_ok=True)
+
+    @contextmanager
+    def __call__(self, key):
+        with self._lock:
+            item = self._locks.setdefault(key, [threading.Lock(), 0])
+            item[1] += 1
+        acquired = item[0].acquire(timeout=self.timeout_s)
+        try:
+            if self.lock_dir:
+                with self._file_lock(key):
+                    yield
+            else:
+                yield
+        finally:
+            if acquired:
+                item[0].release()
+            with self._lock:
+                item[1] -= 1
+                if item[1] == 0:
+                    del self._locks[key]
+
+    @contextmanager
+    def _file_lock(self, key):
+        # The holder deletes the lock file before it releases the lock, so that only the files
+        # of running calculations exist. A waiter that gets the lock of a deleted file tries again.
+        path = os.path.join(self.lock_dir, hashlib.md5(key.encode()).hexdigest() + ".lock")
+        deadline = time.monotonic() + self.timeout_s
+        while True:
+            f = open(path, "a")
+            locked = False
+            while not locked:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    locked = True
+                except BlockingIOError:
+                    if time.monotonic() > deadline:
+                        logging.warning(f"Timeout while waiting for the calculation of {key}")
+                        break
+                    time.sleep(0.05)
+            if not locked or self._is_current(f, path):
+                break
+            f.close()
+        try:
+            yield
+        finally:
+            if locked:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+    @staticmethod
+    def _is_current(f, path):
+        # the open file is still the lock file at path
+        try:
+            return os.stat(path).st_ino == os.fstat(f.fileno()).st_ino
+        except FileNotFoundError:
+            return False
+
+
+class PeriodicValue:
+    """
+    Result of a function that is called every interval_s seconds in a background thread,
+    e.g. the data versions for memoize(). get() never waits for the function: it returns
+    None until the first call succeeded and after a failed call (the value is unknown).
+    The thread is started by the first get().
+    """
+
+    def __init__(self, function, interval_s):
+        self.function = function
+        self.interval_s = interval_s
+        self.value = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True,
+                                                name=f"periodic-{self.function.__name__}")
+                self._thread.start()
+        return self.value
+
+    def _run(self):
+        while True:
+            try:
+                self.value = self.function()
+            except Exception as e:
+                logging.warning(f"{self.function.__name__} failed, the value is unknown: {e}")
+                self.value = None
+            time.sleep(self.interval_s)
+
+
+class _ArrowPayload:
+    # DataFrame of a saved entry as Arrow IPC file, pickling the bytes is a plain copy
+
+    def __init__(self, data):
+        self.data = data
+
+
+class PersistentStore:
+    """
+    Last good value of every key in a file, see persist in memoize()
+
+    The files are written by a background thread, only the newest entry of every
+    key is written. DataFrames are saved as Arrow data without the geometry of a
+    GeoDataFrame (see cache_serializers.ensure_geometry()), other values are pickled.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.pending = {}  # key -> newest entry that is not written yet
+        self._condition = threading.Condition()
+        self._writing = False
+        os.makedirs(directory, exist_ok=True)
+        threading.Thread(target=self._run, daemon=True, name="persistent-store").start()
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.md5(key.encode()).hexdigest() + ".pickle")
+
+    def save(self, key, entry):
+        with self._condition:
+            self.pending[key] = entry
+            self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Wait until all saved entries are written
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: not self.pending and not self._writing, timeout)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self.pending)
+                key, entry = self.pending.popitem()
+                self._writing = True
+            try:
+                self._write(key, entry)
+            except Exception as e:
+                logging.warning(f"Could not save the value of {key}: {e}")
+            finally:
+                with self._condition:
+                    self._writing = False
+                    self._condition.notify_all()
+
+    def _write(self, key, entry):
+        value = entry.value
+        if isinstance(value, cache_serializers.pd.DataFrame) and cache_serializers.available():
+            table = cache_serializers.frame_to_table(value, key)
+            if table is not None:
+                sink = cache_serializers.pa.BufferOutputStream()
+                with cache_serializers.pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+                entry = entry.with_value(_ArrowPayload(sink.getvalue().to_pybytes()))
+        path = self._path(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def load(self, key):
+        """
+        Return the saved CacheEntry or None
+        """
+        try:
+            with open(self._path(key), "rb") as f:
+                entry = pickle.load(f)
+            if isinstance(entry, CacheEntry) and isinstance(entry.value, _ArrowPayload):
+                table = cache_serializers.pa.ipc.open_file(cache_serializers.pa.py_buffer(entry.value.data)).read_all()
+                entry = entry.with_value(cache_serializers.table_to_frame(table))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Could not read the saved value of {key}: {e}")
+            return None
+        return entry if isinstance(entry, CacheEntry) else None
+
+
+def function_key(f, args, kwargs):
+    # stable cache key for a call of f with the given arguments
+    name = f"{f.__module__}.{f.__qualname__}"
+    arguments = repr(args) + repr(sorted(kwargs.items()))
+    return f"{name}:{hashlib.md5(arguments.encode()).hexdigest()}"
+
+
+def memoize(cache, timeout, stale_timeout=None, memory_size=0, single_flight=None, serializer=None, persist=None,
+            data_version=None, unless=False):
+    """
+    Decorator, see above
+
+    :param cache: flask_caching.Cache
+    :param int timeout: number of seconds after which the value is refreshed
+    :param int stale_timeout: number of seconds after which the value is not returned anymore.
+        None: no stale values, i.e. like Cache.memoize()
+    :param int memory_size: number of values in the in-process memory tier, 0 to disable it
+    :param SingleFlight single_flight: coalesce concurrent misses of the same key
+    :param serializer: optional object with dumps(key, value) and loads(stored) to convert the
+        values before they are stored in the cache, see cache_serializers.py
+    :param PersistentStore persist: save the last value of every key to disk and use it on a cache miss
+    :param data_version: function with the arguments of the decorated function that returns the
+        current version of its input data (hashable, None if unknown)
+    :param bool unless: disable caching
+    The decorated function has the additional attributes
+        uncached: the original function
+        cache_key(*args, **kwargs): key of the cache entry
+        get_cached(*args, **kwargs): cached value or None, without calling the function
+        set_cached(value, *args, **kwargs): store a value
+        get_many(arguments, calculate): values of several calls, the misses are calculated together
+        cached_version(*args, **kwargs): version of the cache entry or None, e.g. as data_version
+            of functions that use the value
+        cached_data_version(*args, **kwargs): data version the cache entry was calculated with, or None
+    """
+    hard_timeout = stale_timeout if stale_timeout is not None else timeout
+
+    def decorator(f):
+        refreshing = set()
+        lock = threading.Lock()
+        memory = MemoryLRU(memory_size) if memory_size else None
+        metrics = cache_metrics.metrics_for(f"{f.__module__}.{f.__qualname__}")
+        metrics.memory = memory
+
+        def cache_key(*args, **kwargs):
+            return function_key(f, args, kwargs)
+
+        def store(key, value, version=None):
+            entry = CacheEntry(value, data_version=version)
+            store_entry(key, entry)
+            if persist is not None:
+                persist.save(key, entry)  # written in the background
+
+        def store_entry(key, entry):
+            value = entry.value
+            stored = entry if serializer is None else entry.with_value(serializer.dumps(key, value))
+            cache.set(key, stored, timeout=hard_timeout)
+            cache.set(f"{key}:version", entry.version, timeout=hard_timeout)
+            if memory is not None:
+                memory.put(key, (entry, time.monotonic()))
+            metrics.stored(key, stored.value, hard_timeout)
+
+        def current_data_version(args, kwargs):
+            if data_version is None:
+                return None
+            try:
+                return data_version(*args, **kwargs)
+            except Exception as e:
+                logging.warning(f"Data version of {f.__name__}{args} is unknown: {e}")
+                return None
+
+        def set_cached(value, *args, **kwargs):
+            store(cache_key(*args, **kwargs), value, current_data_version(args, kwargs))
+
+        def get_entry(key):
+            # memory tier first, then the shared cache
+            if memory is not None:
+                item = memory.get(key)
+                if item is not None:
+                    entry, checked = item
+                    if entry.age() <= hard_timeout:
+                        if time.monotonic() - checked < VERSION_CHECK_INTERVAL_S:
+                            metrics.memory_hit()
+                            return entry
+                        if cache.get(f"{key}:version") == entry.version:
+                            memory.put(key, (entry, time.monotonic()))
+                            metrics.memory_hit()
+                            return entry
+                    memory.pop(key)
+            entry = cache.get(key)
+            if not isinstance(entry, CacheEntry):
+                metrics.missing(key)
+                return None
+            if serializer is not None:
+                value = serializer.loads(entry.value)
+                if value is None and entry.value is not None:  # e.g. the Arrow file was removed
+                    metrics.missing(key)
+                    return None
+                entry = entry.with_value(value)
+            if memory is not None:
+                memory.put(key, (entry, time.monotonic()))
+            return entry
+
+        def get_cached(*args, **kwargs):
+            entry = get_entry(cache_key(*args, **kwargs))
+            if entry is not None and entry.outdated(current_data_version(args, kwargs)):
+                entry = None
+            metrics.lookup("miss" if entry is None else "hit")
+            return None if entry is None else entry.value
+
+        def cached_version(*args, **kwargs):
+            entry = get_entry(cache_key(*args, **kwargs))
+            return None if entry is None else entry.version
+
+        def cached_data_version(*args, **kwargs):
+            entry = get_entry(cache_key(*args, **kwargs))
+            return None if entry is None else getattr(entry, "data_version", None)
+
+        def refresh(key, args, kwargs, calculation="miss", version=None):
+            # the data version is determined before the calculation, newer data is picked up by the next call
+            t0 = time.monotonic()
+            try:
+                value = f(*args, **kwargs)
+            except Exception:
+                metrics.calculated(calculation, time.monotonic() - t0, failed=True)
+                raise
+            metrics.calculated(calculation, time.monotonic() - t0)
+            store(key, value, version)
+            return value
+
+        def load_persisted(key):
+            # last good value from disk, put back into the cache with its original age
+            entry = persist.load(key) if persist is not None else None
+            if entry is not None:
+                logging.info(f"Using the saved value of {f.__name__} from {time.ctime(entry.created)}")
+                store_entry(key, entry)
+            return entry
+
+        def refresh_in_background(key, args, kwargs, version):
+            with lock:
+                if key in refreshing:
+                    return
+                refreshing.add(key)
+            # other processes that share the cache
+            if not cache.add(f"{key}:refreshing", True, timeout=REFRESH_LOCK_TIMEOUT_S):
+                with lock:
+                    refreshing.discard(key)
+                return
+
+            def run():
+                try:
+                    logging.debug(f"Background refresh of {f.__name__}{args}")
+                    refresh(key, args, kwargs, calculation="refresh", version=version)
+                except Exception:
+                    logging.exception(f"Background refresh of {f.__name__}{args} failed")
+                finally:
+                    cache.delete(f"{key}:refreshing")
+                    with lock:
+                        refreshing.discard(key)
+
+            threading.Thread(target=run, daemon=True).start()
+
+        def lazy_version(args, kwargs):
+            # the data version is only determined when it is needed
+            known = {}
+
+            def version():
+                if "version" not in known:
+                    known["version"] = current_data_version(args, kwargs)
+                return known["version"]
+            return version
+
+        def usable(entry, version):
+            # without stale values, an entry of an old data version is a miss
+            return entry is not None and (stale_timeout is not None or not entry.outdated(version()))
+
+        def serve(key, args, kwargs, entry, version, result=None):
+            if entry.age() > timeout or entry.outdated(version()):
+                metrics.lookup(result or "stale")
+                refresh_in_background(key, args, kwargs, version())
+            else:
+                metrics.lookup(result or "hit")
+            return entry.value
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if unless:
+                return f(*args, **kwargs)
+            key = cache_key(*args, **kwargs)
+            version = lazy_version(args, kwargs)
+            entry = get_entry(key)
+            result = None
+            if not usable(entry, version):
+                with single_flight(key) if single_flight is not None else nullcontext():
+                    if single_flight is not None:
+                        # calculated by someone else while waiting?
+                        entry = get_entry(key)
+                        if usable(entry, version):
+                            result = "coalesced"
+                    if not usable(entry, version):
+                        entry = load_persisted(key)
+                    if not usable(entry, version):
+                        metrics.lookup("miss")
+                        return refresh(key, args, kwargs, version=version())
+            return serve(key, args, kwargs, entry, version, result)
+
+        def get_many(arguments, calculate):
+            """
+            Values of the calls with a single argument each (e.g. station ids) as dict argument -> value.
+            Cached values are served like by the decorated function, the misses are calculated together
+            by calculate(list of arguments) -> dict argument -> value and stored in their own entries.
+            Concurrent calls with the same misses are coalesced by single_flight.
+            """
+            arguments = list(dict.fromkeys(arguments))
+            if unless:
+                return calculate(arguments)
+            output = {}
+            pending = {}  # argument -> key, version
+            for x in arguments:
+                key, version = cache_key(x), lazy_version((x,), {})
+                entry = get_entry(key)
+                if usable(entry, version):
+                    output[x] = serve(key, (x,), {}, entry, version)
+                else:
+                    pending[x] = key, version
+            if not pending:
+                return output
+            missing_keys = " ".join(sorted(key for key, _ in pending.values()))
+            batch_key = f"{f.__module__}.{f.__qualname__}:many:{hashlib.md5(missing_keys.encode()).hexdigest()}"
+            with single_flight(batch_key) if single_flight is not None else nullcontext():
+                for x, (key, version) in list(pending.items()):
+                    entry = get_entry(key) if single_flight is not None else None
+                    result = "coalesced" if usable(entry, version) else None
+                    if not usable(entry, version):
+                        entry = load_persisted(key)
+                    if usable(entry, version):
+                        output[x] = serve(key, (x,), {}, entry, version, result)
+                        del pending[x]
+                if not pending:
+                    return output
+                versions = {x: version() for x, (_, version) in pending.items()}
+                t0 = time.monotonic()
+                try:
+                    values = calculate(list(pending))
+                except Exception:
+                    metrics.calculated("miss", time.monotonic() - t0, failed=True)
+                    raise
+                metrics.calculated("miss", time.monotonic() - t0)
+                for x, (key, _) in pending.items():
+                    metrics.lookup("miss")
+                    output[x] = values.get(x)
+                    store(key, output[x], versions[x])  # None (no data) is cached like any other value
+            return output
+
+        wrapper.uncached = f
+        wrapper.cache_key = cache_key
+        wrapper.get_cached = get_cached
+        wrapper.set_cached = set_cached
+        wrapper.get_many = get_many
+        wrapper.cached_version = cached_version
+        wrapper.cached_data_version = cached_data_version
+        wrapper.memory = memory
+        wrapper.metrics = metrics
+        return wrapper
+
+    return decorator
+
+
+def start_refresher(interval_s, functions):
+    """
+    Call the functions every interval_s seconds in a background thread, so that
+    the memoized values are refreshed even without requests
+
+    :param list functions: functions without arguments, e.g. memoized functions with default arguments
+    """
+    def run():
+        while True:
+            time.sleep(interval_s)
+            for function in functions:
+                try:
+                    function()
+                except Exception:
+                    logging.exception(f"Auto-refresh of {function.__name__} failed")
+
+    thread = threading.Thread(target=run, daemon=True, name="cache-refresher")
+    thread.start()
+    return thread
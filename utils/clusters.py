@@ -0,0 +1,113 @@
+"""
+Clusters of the stations for the map at low zoom levels
+
+The stations are grouped by a grid in web mercator coordinates, the same projection
+as the map. The cells of zoom level z are CLUSTER_PX pixels wide at this zoom, so
+a cell of level z contains four cells of level z + 1 (a quadtree). The clusters are
+precalculated for all levels from MIN_CLUSTER_ZOOM to MAX_CLUSTER_ZOOM, the map
+shows the level of its current zoom (see assets/map_figure.js). At higher zoom
+levels, the single stations are shown. The number of markers of a level is limited
+by the number of cells in Germany, not by the number of stations.
+
+From CULL_MIN_ZOOM on, only a part of Germany is visible. The clusters of these
+levels and the single stations are split into the map tiles of TILE_ZOOM, the
+browser only loads the tiles around the visible part of the map (viewport culling).
+"""
+
+import numpy as np
+import pandas as pd
+
+TILE_PX = 512  # size of a map tile of mapbox
+CLUSTER_PX = 32  # size of the grid cells, TILE_PX / CLUSTER_PX cells per tile
+MIN_CLUSTER_ZOOM = 4
+MAX_CLUSTER_ZOOM = 10
+TILE_ZOOM = 8  # zoom level of the tiles for the viewport culling, about 1.4 degrees wide
+CULL_MIN_ZOOM = 9
+MAX_LATITUDE = 85.0511  # limit of web mercator
+
+
+def mercator(lat, lon):
+    """
+    Web mercator coordinates, x and y from 0 to 1 (west to east and north to south)
+    """
+    lat = np.radians(np.clip(np.asarray(lat, dtype=float), -MAX_LATITUDE, MAX_LATITUDE))
+    x = (np.asarray(lon, dtype=float) + 180) / 360
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2
+    return x, y
+
+
+def cluster_level(zoom):
+    """
+    Cluster level of a zoom level of the map, None: single stations
+    """
+    if zoom is None:
+        return None
+    level = max(MIN_CLUSTER_ZOOM, int(np.floor(zoom)))
+    return level if level <= MAX_CLUSTER_ZOOM else None
+
+
+class GridIndex:
+
+    def __init__(self, lat, lon):
+        """
+        :param lat: latitudes of the stations
+        :param lon: longitudes of the stations, in the same order
+        """
+        self.x, self.y = mercator(lat, lon)
+        self.valid = np.isfinite(self.x) & np.isfinite(self.y)
+
+    def _grid(self, cells_per_side):
+        column = np.where(self.valid, np.floor(np.nan_to_num(self.x) * cells_per_side), -1).astype(np.int64)
+        row = np.where(self.valid, np.floor(np.nan_to_num(self.y) * cells_per_side), -1).astype(np.int64)
+        return column, row
+
+    def cells(self, zoom):
+        """
+        Grid cell (column, row) of every station at the zoom level, -1 for stations without coordinates
+        """
+        return self._grid(TILE_PX // CLUSTER_PX * 2 ** zoom)
+
+    def tiles(self, tile_zoom=TILE_ZOOM):
+        """
+        Map tile (column, row) of every station, -1 for stations without coordinates
+        """
+        return self._grid(2 ** tile_zoom)
+
+    def clusters(self, zoom, lat, lon, trend):
+        """
+        Stations grouped by the cells of the zoom level
+
+        :return pandas.DataFrame: columns lat, lon (mean position), trend (mean trend),
+            count (number of stations) and first (position of the first station in the input)
+        """
+        column, row = self.cells(zoom)
+        df = pd.DataFrame(dict(column=column, row=row,
+                               lat=np.asarray(lat, dtype=float), lon=np.asarray(lon, dtype=float),
+                               trend=np.asarray(trend, dtype=float), first=np.arange(len(column))))
+        df = df[self.valid]
+        return df.groupby(["column", "row"], sort=False).agg(
+            lat=("lat", "mean"),
+            lon=("lon", "mean"),
+            trend=("trend", "mean"),
+            count=("first", "size"),
+            first=("first", "first")).reset_index(drop=True)
+
+
+def tile_keys(lat, lon, tile_zoom=TILE_ZOOM):
+    """
+    Map tile "column_row" of every point, None for points without coordinates
+    """
+    column, row = GridIndex(lat, lon).tiles(tile_zoom)
+    return [f"{c}_{r}" if c >= 0 else None for c, r in zip(column, row)]
+
+
+if __name__ == '__main__':
+    """
+    Number of markers per zoom level for random stations in Germany
+    """
+    rng = np.random.default_rng(0)
+    for n in [1000, 10000, 100000]:
+        lat, lon = rng.uniform(47.3, 55, n), rng.uniform(5.9, 15, n)
+        index = GridIndex(lat, lon)
+        counts = [len(index.clusters(z, lat, lon, rng.normal(size=n))) for z in range(MIN_CLUSTER_ZOOM, MAX_CLUSTER_ZOOM + 1)]
+        print(f"{n} stations: {counts} markers at zoom {MIN_CLUSTER_ZOOM}-{MAX_CLUSTER_ZOOM}")
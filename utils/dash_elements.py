@@ -268,13 +268,26 @@ def mainmap():
     )
 
 
-def storage():
-    # dcc Storage
+def storage(artifact_url_refresh_s=None):
+    """
+    dcc Storage
+
+    :param int artifact_url_refresh_s: interval for the refresh of the map stores with the
+        URLs of the static files (see trace_artifacts.py), None without static files
+    """
     return [
         dcc.Store(id='clientside_callback_storage', storage_type='memory'),
         dcc.Store(id='nominatim_storage', storage_type='memory'),
         dcc.Store(id='urlbar_storage', storage_type='memory'),
         dcc.Store(id='highlight_polygon', storage_type='memory'),
+        dcc.Store(id='map_traces_storage', storage_type='memory'),
+        dcc.Store(id='map_geometry_storage', storage_type='memory'),
+        dcc.Store(id='map_geometry_tolerance', storage_type='memory'),
+        dcc.Store(id='map_view_storage', storage_type='memory'),
+        # redraws the map while static files are loaded in the background (see assets/map_figure.js)
+        dcc.Interval(id='map_artifacts_interval', interval=200, disabled=True),
+        dcc.Interval(id='map_artifacts_refresh_interval', interval=1000 * (artifact_url_refresh_s or 3600),
+                     disabled=artifact_url_refresh_s is None),
         dcc.Store(id='latlon_local_storage', storage_type='local', data=(50.144, 8.617, "Frankfurt am Main")),
     ]
 
@@ -0,0 +1,113 @@
+"""
+Geometries of the counties (landkreis) and states (bundesland) for the choropleth maps
+
+The GeoJSON files are loaded once. Simplified versions of the geometries are
+calculated for several tolerances with coverage simplification, i.e. the shared
+borders of neighbouring regions stay identical and there are no gaps. The
+coordinates are rounded to PRECISION degrees.
+region_geojson() returns only the regions with stations, in the resolution that
+fits the zoom level of the map. With the coarsest level, the choropleth of all
+counties is less than 100 kB instead of 1.3 MB.
+"""
+
+import json
+import os
+from functools import lru_cache
+import numpy as np
+import shapely
+import shapely.geometry
+
+GEOJSON_DIR = os.path.join(os.path.dirname(__file__), "geofeatures-ags-germany")
+GEOJSON_FILES = {"landkreis": "counties.json", "bundesland": "states.json"}
+# (maximum zoom level, tolerance in degrees), tolerance 0: original geometries
+ZOOM_TOLERANCES = ((6.5, 0.1), (7.5, 0.05), (8.5, 0.02), (10, 0.005))
+PRECISION = 0.001  # about 100 m
+
+
+@lru_cache(maxsize=None)
+def load_geojson(region):
+    """
+    Original GeoJSON of "landkreis" or "bundesland"
+    """
+    with open(os.path.join(GEOJSON_DIR, GEOJSON_FILES[region]), "r") as f:
+        return json.load(f)
+
+
+def _polygonal(geometry):
+    # make_valid() can return collections with lines, only the polygons are needed
+    if geometry.geom_type in ("Polygon", "MultiPolygon"):
+        return geometry
+    return shapely.union_all([x for x in geometry.geoms if x.geom_type in ("Polygon", "MultiPolygon")])
+
+
+@lru_cache(maxsize=None)
+def _geometries(region):
+    features = load_geojson(region)["features"]
+    ids = [x["id"] for x in features]
+    geometries = shapely.make_valid(np.array([shapely.geometry.shape(x["geometry"]) for x in features]))
+    return ids, np.array([_polygonal(x) for x in geometries])
+
+
+def _simplify(geometries, tolerance):
+    if hasattr(shapely, "coverage_simplify"):  # shapely >= 2.1 with GEOS >= 3.12
+        try:
+            return shapely.coverage_simplify(geometries, tolerance)
+        except shapely.errors.GEOSException:
+            pass
+    # fallback: every geometry on its own, the tolerance of coverage_simplify() is
+    # the square root of the removed areas, roughly four times the distance of simplify()
+    return shapely.simplify(geometries, tolerance / 4, preserve_topology=True)
+
+
+@lru_cache(maxsize=None)
+def simplified_features(region, tolerance):
+    """
+    dict AGS -> GeoJSON feature of the regions, simplified with the given tolerance
+    """
+    ids, original = _geometries(region)
+    geometries = original
+    if tolerance:
+        geometries = shapely.set_precision(_simplify(original, tolerance), PRECISION)
+        # keep tiny regions that vanished
+        geometries = np.where(shapely.is_empty(geometries), original, geometries)
+    return {ags: dict(type="Feature", id=ags, geometry=shapely.geometry.mapping(geometry))
+            for ags, geometry in zip(ids, geometries)}
+
+
+def tolerance_for_zoom(zoom):
+    if zoom is None:
+        return ZOOM_TOLERANCES[0][1]
+    for max_zoom, tolerance in ZOOM_TOLERANCES:
+        if zoom <= max_zoom:
+            return tolerance
+    return 0
+
+
+@lru_cache(maxsize=64)
+def _feature_collection(region, ags, tolerance):
+    features = simplified_features(region, tolerance)
+    return dict(type="FeatureCollection", features=[features[x] for x in ags if x in features])
+
+
+def region_geojson(region, ags, zoom=None, tolerance=None):
+    """
+    GeoJSON of the given regions for a choropleth map
+
+    :param str region: "landkreis" or "bundesland"
+    :param ags: AGS of the regions to include, e.g. the regions with stations
+    :param float zoom: zoom level of the map, None: the whole country is visible
+    :param float tolerance: tolerance of the simplification instead of the one of the zoom level
+    """
+    if tolerance is None:
+        tolerance = tolerance_for_zoom(zoom)
+    return _feature_collection(region, tuple(sorted(set(ags))), tolerance)
+
+
+if __name__ == '__main__':
+    """
+    Size of the GeoJSON of all counties per zoom level
+    """
+    ags = simplified_features("landkreis", 0).keys()
+    for zoom in [None] + [x for x, _ in ZOOM_TOLERANCES] + [12]:
+        size = len(json.dumps(region_geojson("landkreis", ags, zoom), separators=(",", ":")))
+        print(f"zoom {zoom}: tolerance {tolerance_for_zoom(zoom)}, {size // 1000} kB")
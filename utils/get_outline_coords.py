@@ -10,19 +10,10 @@ Alternatively, get them from github by web request:
     geojson_lk = requests.get(url_lk).json()
 """
 
-import json
+from utils.geometry import load_geojson
 
-if __name__ == '__main__':
-    file_lk = "geofeatures-ags-germany/counties.json"
-    file_bk = "geofeatures-ags-germany/states.json"
-else:
-    file_lk = "utils/geofeatures-ags-germany/counties.json"
-    file_bk = "utils/geofeatures-ags-germany/states.json"
-
-with open(file_lk, "r") as f:
-    geojson_lk = json.load(f)
-with open(file_bk, "r") as f:
-    geojson_bl = json.load(f)
+geojson_lk = load_geojson("landkreis")
+geojson_bl = load_geojson("bundesland")
 
 
 def get_outline_coords(detail, ags):
@@ -4,7 +4,7 @@ utility functions for the frontend
 
 from math import isnan, log
 from datetime import timedelta
-from numpy import nan
+from numpy import nan, int64
 import pandas as pd
 import logging
 import pytz
@@ -27,6 +27,50 @@ def trend2color(trendvalue, alpha=1):
         return f"rgba(230, 200, 0, {alpha})"
 
 
+def format_trend_str(trend_float):
+    if isnan(trend_float):
+        return '<i>nicht verfügbar</i>'
+    trend_str = str(round(100 * trend_float)) + '%'
+    if trend_float > 0:
+        trend_str = '+' + trend_str
+    return trend_str
+
+
+def region_tooltiptext(region_name, trend_mean, size):
+    """
+    map hoverinfo of a region with the mean trend of its size stations
+    """
+    trend_str = format_trend_str(trend_mean)
+    return (
+        f"<span style='font-size:1.5em'><b>{region_name}</b></span><br>"
+        f"<span style='font-size:0.85em; opacity:0.8;'>Messpunkte: {size}</span><br>"
+        f"<span style='font-size:1em'><b>Durchschnittlicher Trend:</b></span>"
+        f"<span style='font-size:1.5em'> {trend_str}</span>"
+        f"<br><br><span style='font-size:0.85em; opacity:0.8;'>Anklicken um mehr Informationen zu erhalten!</span>"
+    )
+
+
+def cluster_tooltiptext(count, trend_mean):
+    """
+    map hoverinfo of a cluster of count stations with their mean trend
+    """
+    trend_str = format_trend_str(trend_mean)
+    return (
+        f"<span style='font-size:1.5em'><b>{count} Messpunkte</b></span><br>"
+        f"<span style='font-size:1em'><b>Durchschnittlicher Trend:</b></span>"
+        f"<span style='font-size:1.5em'> {trend_str}</span>"
+        f"<br><br><span style='font-size:0.85em; opacity:0.8;'>Hineinzoomen um die einzelnen Messpunkte zu sehen!</span>"
+    )
+
+
+def is_cluster_click(click_data):
+    """
+    True if the map clickData is a cluster of several stations, see map_traces.cluster_traces()
+    """
+    point = click_data["points"][0]
+    return point.get("curveNumber", 0) > 0 and "location" not in point and point.get("customdata") is None
+
+
 def tooltiptext(df, mode):
     """
     generate texts list for map hoverinfo
@@ -34,14 +78,6 @@ def tooltiptext(df, mode):
     because css class attributes are stripped by Dash
     """
 
-    def format_trend_str(trend_float):
-        if isnan(trend_float):
-            return '<i>nicht verfügbar</i>'
-        trend_str = str(round(100 * trend_float)) + '%'
-        if trend_float > 0:
-            trend_str = '+' + trend_str
-        return trend_str
-
     if mode == "stations":
         def make_string(row):
             if isnan(row["last_value"]):
@@ -71,16 +107,7 @@ def tooltiptext(df, mode):
             return s
     else:
         def make_string(row):
-            trend_str = format_trend_str(row["trend"]["mean"])
-            size = row["trend"]["size"]
-            s = (
-                f"<span style='font-size:1.5em'><b>{row[mode].to_string().strip()}</b></span><br>"
-                f"<span style='font-size:0.85em; opacity:0.8;'>Messpunkte: {size}</span><br>"
-                f"<span style='font-size:1em'><b>Durchschnittlicher Trend:</b></span>"
-                f"<span style='font-size:1.5em'> {trend_str}</span>"
-                f"<br><br><span style='font-size:0.85em; opacity:0.8;'>Anklicken um mehr Informationen zu erhalten!</span>"
-            )
-            return s
+            return region_tooltiptext(row[mode].to_string().strip(), row["trend"]["mean"], row["trend"]["size"])
     return list(df.apply(lambda x: make_string(x), axis=1))
 
 
@@ -168,14 +195,15 @@ def apply_model_fit(df, model, trend_window):
     b (offset) to the unixtimestamp value of "_time". Do this only
     for values inside the trend_window
     """
+    df = df.copy()
     df["fit"] = nan
     try:
         a, b = model
     except TypeError:
         return df
     day0 = max(df["_time"]) - timedelta(days=trend_window - 1)
-    df.loc[df["_time"] >= day0, "fit"] = df[df["_time"] >= day0].apply(lambda x: a * int(x["_time"].timestamp()) + b,
-                                                                       axis=1)
+    in_window = df["_time"] >= day0
+    df.loc[in_window, "fit"] = a * unixtime(df.loc[in_window, "_time"]) + b
     return df
 
 
@@ -191,8 +219,8 @@ def filter_by_consent(df):
     except ValueError:
         logging.warning("Cannot read webcam JSON")
         return pd.DataFrame()  # empty dataframe
-    webcams_df["ID_Name"] = webcams_df.apply(lambda x: str(x["ID"]) + "_" + x["Name"], 1)
-    df["ID_Name"] = df.apply(lambda x: x["_id"].split("_")[0] + "_" + x["name"], 1)
+    webcams_df["ID_Name"] = webcams_df["ID"].astype(str) + "_" + webcams_df["Name"]
+    df["ID_Name"] = df["_id"].astype(str).str.split("_").str[0] + "_" + df["name"].astype(str)
     webcams_df = webcams_df[["ID_Name", "consent"]]
     df = df.merge(webcams_df, on="ID_Name", how="left")
     df = df[df["consent"] == True]
@@ -204,5 +232,23 @@ local_tz = pytz.timezone('Europe/Berlin')
 
 
 def utc_to_local(utc_dt):
-    local_dt = utc_dt.replace(tzinfo=pytz.utc).astimezone(local_tz)
+    if utc_dt.tzinfo is None:
+        utc_dt = utc_dt.replace(tzinfo=pytz.utc)
+    local_dt = utc_dt.astimezone(local_tz)
     return local_tz.normalize(local_dt)
+
+
+def series_utc_to_local(utc_series):
+    """
+    Vectorized version of utc_to_local() for a pandas Series of datetimes
+    """
+    utc_series = pd.to_datetime(utc_series, utc=True)
+    return utc_series.dt.tz_convert(local_tz)
+
+
+def unixtime(time_series):
+    """
+    Unix time in s (int64) for a pandas Series of timezone aware datetimes
+    """
+    utc_series = pd.to_datetime(time_series, utc=True)
+    return utc_series.values.astype("datetime64[s]").astype(int64)
@@ -0,0 +1,132 @@
+"""
+HTTP caching of the widget
+
+Widgets are embedded by other websites and loaded again and again with the same
+query string. A widget load consists of the page itself (GET /widget?...) and the
+Dash callbacks with the input "url-widget" (build_widget, set_widget_width,
+set_classname). Both only change when the station gets new data, so the version
+of a response is
+    - the query string (the widget parameters)
+    - the time of the last datapoint of the station
+    - the version of the code and assets
+The page gets an ETag and a Cache-Control max-age, requests with a matching
+If-None-Match get a "304 Not Modified". Browsers do not revalidate the POST
+requests of the callbacks, so their responses are kept in an in-process LRU instead
+and the callbacks only run once per widget and data version.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from urllib.parse import parse_qs
+from flask import request, g, Response
+from utils.caching import MemoryLRU
+
+WIDGET_PATH = "/widget"
+WIDGET_INPUT_ID = "url-widget"
+CALLBACK_PATH = "/_dash-update-component"
+
+
+def make_etag(*parts):
+    return hashlib.md5("|".join(str(x) for x in parts).encode()).hexdigest()
+
+
+def source_version(directories):
+    """
+    Version of the code and assets: hash of the paths and contents of their files, the
+    same in all processes that were started from the same files. Compiled files are
+    skipped, they are written by whichever process imports a module first.
+    """
+    content_hash = hashlib.md5()
+    for directory in directories:
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = sorted(x for x in dirs if x != "__pycache__")
+            for name in sorted(files):
+                if name.endswith((".pyc", ".pyo")):
+                    continue
+                path = os.path.join(root, name)
+                content_hash.update(path.encode())
+                with open(path, "rb") as f:
+                    content_hash.update(f.read())
+    return content_hash.hexdigest()
+
+
+def _station(search):
+    # c_id from the query string of the widget
+    urlparams = parse_qs((search or "").replace("?", ""))
+    return urlparams.get("station", [None])[0]
+
+
+class WidgetHttpCache:
+
+    def __init__(self, data_version, max_age_s, code_version="", maxsize=1024):
+        """
+        :param data_version: function c_id -> version of the data of the station, e.g. the last time
+        :param int max_age_s: Cache-Control max-age of the widget page, i.e. the refresh cadence of the data
+        :param str code_version: part of every ETag, see source_version()
+        :param int maxsize: number of callback responses kept in memory
+        """
+        self.data_version = data_version
+        self.max_age_s = max_age_s
+        self.code_version = code_version
+        self.responses = MemoryLRU(maxsize)
+
+    def init_app(self, server):
+        server.before_request(self._before_request)
+        server.after_request(self._after_request)
+
+    def _version(self, search):
+        c_id = _station(search)
+        try:
+            data_version = self.data_version(c_id) if c_id else None
+        except Exception as e:
+            logging.warning(f"No data version for the widget of {c_id}: {e}")
+            return None  # not cacheable
+        return make_etag(self.code_version, search, data_version)
+
+    def _before_request(self):
+        if request.method == "GET" and request.path.rstrip("/") == WIDGET_PATH:
+            etag = self._version(request.query_string.decode())
+            if etag is None:
+                return None
+            g.widget_etag = etag
+            if etag in request.if_none_match:
+                return self._not_modified(etag)
+        elif request.method == "POST" and request.path.endswith(CALLBACK_PATH):
+            body = request.get_data()
+            try:
+                payload = json.loads(body)
+            except ValueError:
+                return None
+            search = [x.get("value") for x in payload.get("inputs", []) if x.get("id") == WIDGET_INPUT_ID]
+            if len(search) != 1:
+                return None  # not a widget callback
+            version = self._version(search[0])
+            if version is None:
+                return None
+            key = make_etag(body, version)
+            cached = self.responses.get(key)
+            if cached is not None:
+                data, mimetype = cached
+                return Response(data, mimetype=mimetype)
+            g.widget_callback_key = key
+        return None
+
+    def _after_request(self, response):
+        if response.status_code != 200:
+            return response
+        etag = g.pop("widget_etag", None)
+        if etag is not None:
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = f"public, max-age={self.max_age_s}"
+        key = g.pop("widget_callback_key", None)
+        if key is not None:
+            self.responses.put(key, (response.get_data(), response.mimetype))
+        return response
+
+    def _not_modified(self, etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = f"public, max-age={self.max_age_s}"
+        return response
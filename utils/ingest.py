@@ -0,0 +1,240 @@
+"""
+Typed ingestion of InfluxDB query results
+
+The annotated CSV response of a Flux query is read line by line and converted
+into typed columns in chunks while it arrives:
+    - dateTime columns are parsed into int64 epoch times (datetime64, converted
+      to local time at once for the whole column)
+    - double/long/boolean columns become numpy arrays
+    - string columns (tags) become categoricals
+
+This replaces query_api.query_data_frame() followed by row-wise df.apply()
+calls. See https://docs.influxdata.com/influxdb/v2.0/reference/syntax/annotated-csv/
+"""
+
+import codecs
+import csv
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+from utils import helpers
+
+CHUNK_SIZE = 50000  # number of rows to buffer before converting them to typed columns
+DROP_COLUMNS = {"", "result", "table"}  # columns from the CSV format that are never used
+
+
+class FluxQueryError(Exception):
+    pass
+
+
+def _convert(values, datatype, default):
+    """
+    Convert a list of strings from the CSV into a typed array
+    """
+    if default is not None and default != "":
+        values = [x if x != "" else default for x in values]
+    values = pd.Series(values, dtype=object)
+    values = values.mask(values == "")  # empty strings are missing values
+    if datatype.startswith("dateTime"):
+        # int64 epoch times
+        return pd.to_datetime(values, utc=True)
+    elif datatype == "double":
+        return pd.to_numeric(values).astype(float)
+    elif datatype in ("long", "unsignedLong"):
+        numbers = pd.to_numeric(values)
+        if numbers.isna().any():
+            return numbers.astype(float)
+        return numbers.astype(np.int64)
+    elif datatype == "boolean":
+        return values.map({"true": True, "false": False})
+    else:
+        # tags and string fields
+        return values.astype("category")
+
+
+class _ChunkBuilder:
+    """
+    Collects the rows of the annotated CSV and converts them chunk-wise
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.datatypes = {}
+        self.defaults = {}
+        self.header = None
+        self.rows = []
+
+    def new_table(self, datatypes, defaults, header):
+        # every table is converted with its own annotations, to_frame() merges the dtypes
+        self.flush()
+        self.header = header
+        self.datatypes = dict(zip(header, datatypes))
+        self.defaults = dict(zip(header, defaults))
+
+    def append(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        columns = list(zip(*self.rows))
+        chunk = {}
+        for name, values in zip(self.header, columns):
+            if name in DROP_COLUMNS:
+                continue
+            chunk[name] = _convert(values, self.datatypes[name], self.defaults[name]).reset_index(drop=True)
+        self.chunks.append(pd.DataFrame(chunk))
+        self.rows = []
+
+    def to_frame(self):
+        self.flush()
+        if not self.chunks:
+            return pd.DataFrame()
+        if len(self.chunks) == 1:
+            return self.chunks[0]
+        # pd.concat() merges the other dtypes, e.g. long and double to float64, strings and numbers to object
+        columns = []
+        for chunk in self.chunks:
+            columns += [x for x in chunk.columns if x not in columns]
+        # categoricals can only be concatenated without conversion to object if the categories are equal
+        for name in columns:
+            pieces = [chunk[name] for chunk in self.chunks if name in chunk.columns]
+            if not all(isinstance(x.dtype, pd.CategoricalDtype) for x in pieces):
+                continue
+            categories = union_categoricals(pieces, ignore_order=True).categories
+            for chunk in self.chunks:
+                if name in chunk.columns:
+                    chunk[name] = chunk[name].cat.set_categories(categories)
+                else:
+                    chunk[name] = pd.Categorical([None] * len(chunk), categories=categories)
+        return pd.concat(self.chunks, ignore_index=True, sort=False)
+
+
+def parse_annotated_csv(lines):
+    """
+    Parse the annotated CSV of a Flux query result into a single DataFrame
+
+    :param lines: iterable of strings, e.g. a decoded HTTP response
+    :return pandas.DataFrame: all tables of the result. Columns that are missing in
+    some tables are filled with NaN
+    """
+    builder = _ChunkBuilder()
+    datatypes, defaults = [], []
+    expect_header = False
+    for row in csv.reader(lines):
+        if not row or (len(row) == 1 and row[0] == ""):
+            continue  # empty line between tables
+        if row[0] == "#datatype":
+            datatypes = row
+            defaults = [""] * len(row)
+            expect_header = True
+        elif row[0] == "#default":
+            defaults = row
+        elif row[0].startswith("#"):
+            continue  # #group and other annotations
+        elif expect_header:
+            builder.new_table(datatypes, defaults, row)
+            expect_header = False
+        elif builder.header[1:3] == ["error", "reference"]:
+            raise FluxQueryError(row[1])
+        else:
+            builder.append(row)
+    return builder.to_frame()
+
+
+def query_frame(query_api, query, local_time=True, unixtime=False):
+    """
+    Run a Flux query and return the result as typed DataFrame
+
+    :param query_api: InfluxDB QueryApi (or anything else with a query_raw method)
+    :param str query: Flux query
+    :param bool local_time: convert all time columns from UTC to local time (Europe/Berlin)
+    :param bool unixtime: add a "unixtime" column with the int64 unix time in s of "_time"
+    :return pandas.DataFrame:
+    """
+    response = query_api.query_raw(query)
+    try:
+        df = parse_annotated_csv(codecs.iterdecode(response, "utf-8"))
+    finally:
+        response.close()
+    if df.empty:
+        return df
+    if local_time:
+        for column in df.columns:
+            if isinstance(df[column].dtype, pd.DatetimeTZDtype):
+                df[column] = helpers.series_utc_to_local(df[column])
+    if unixtime and "_time" in df.columns:
+        df["unixtime"] = helpers.unixtime(df["_time"])
+    return df
+
+
+def decategorize(df):
+    """
+    Convert categorical columns back to object columns,
+    e.g. for small tables that are used for groupby operations later
+    """
+    categorical = [x for x in df.columns if isinstance(df[x].dtype, pd.CategoricalDtype)]
+    return df.astype({x: object for x in categorical})
+
+
+if __name__ == '__main__':
+    """
+    Test: parse two tables with different schema
+    """
+    print("== TEST ==")
+    testcsv = """#datatype,string,long,dateTime:RFC3339,double,string,string,string
+#group,false,false,false,false,true,true,true
+#default,_result,,,,,,
+,result,table,_time,_value,_field,_measurement,_id
+,,0,2020-07-01T10:00:00Z,12,personenzahl,webcam,1
+,,0,2020-07-01T11:00:00Z,13.5,personenzahl,webcam,1
+,,1,2020-07-01T10:00:00Z,,personenzahl,webcam,2
+
+#datatype,string,long,dateTime:RFC3339,double,string,string,string,string
+#group,false,false,false,false,true,true,true,true
+#default,_result,,,,,,,
+,result,table,_time,_value,_field,_measurement,_id,city
+,,2,2020-07-01T09:00:00Z,3,count,writeapi,x,Berlin
+"""
+    df = parse_annotated_csv(testcsv.splitlines())
+    print(df)
+    print(df.dtypes)
+    assert len(df) == 4
+    assert df["_value"].isna().sum() == 1
+    assert df["city"].isna().sum() == 3
+    # the same column with different types in two tables
+    mixedcsv = """#datatype,string,long,dateTime:RFC3339,long,string
+#group,false,false,false,false,true
+#default,_result,,,,
+,result,table,_time,_value,_measurement
+,,0,2020-07-01T10:00:00Z,12,webcam
+
+#datatype,string,long,dateTime:RFC3339,double,string
+#group,false,false,false,false,true
+#default,_result,,,,
+,result,table,_time,_value,_measurement
+,,1,2020-07-01T10:00:00Z,13.5,hystreet
+,,1,2020-07-01T11:00:00Z,0.25,hystreet
+
+#datatype,string,long,dateTime:RFC3339,string,string
+#group,false,false,false,false,true
+#default,_result,,,,
+,result,table,_time,_value,_measurement
+,,2,2020-07-01T10:00:00Z,open,bikes
+"""
+    df = parse_annotated_csv(mixedcsv.splitlines())
+    print(df)
+    assert list(df["_value"]) == [12, 13.5, 0.25, "open"]
+    assert parse_annotated_csv(mixedcsv.splitlines()[:13])["_value"].dtype == np.float64
+    errorcsv = """#datatype,string,string
+#group,true,true
+#default,,
+,error,reference
+,some error,897
+"""
+    try:
+        parse_annotated_csv(errorcsv.splitlines())
+    except FluxQueryError as e:
+        print(f"\nFluxQueryError: {e}")
@@ -0,0 +1,64 @@
+"""
+Table of the last datapoint of every station
+
+The last value of the main field and the "open" state of all stations are
+requested with a single grouped last() query (queries.load_last_values()).
+Lookups by c_id are hash index lookups, so widgets are served without a query
+to the InfluxDB. The query result comes from a load function, usually memoized
+in a shared cache (see cached_functions.py), so that one process refreshes the
+table for all others. The index is rebuilt when load() returns a new object.
+"""
+
+import threading
+import pandas as pd
+from utils import queries, helpers
+
+
+class LastValueTable:
+
+    def __init__(self, measurements, load):
+        """
+        :param list measurements: measurements in the table
+        :param load: function without arguments that returns the output of
+            queries.load_last_values() for these measurements
+        """
+        self.measurements = list(measurements)
+        self.load = load
+        self.tables = {}  # _field -> DataFrame with index c_id
+        self._source = None  # DataFrame the tables were built from
+        self._lock = threading.Lock()
+
+    def _get_tables(self):
+        df = self.load()
+        with self._lock:
+            if df is not self._source:
+                tables = {}
+                for _field, group in df.groupby("_field", sort=False):
+                    group = group.set_index("c_id", drop=False)
+                    group.index.name = None
+                    tables[_field] = group
+                self.tables = tables
+                self._source = df
+            return self.tables
+
+    def covers(self, c_id):
+        _measurement, _ = queries.split_compound_index(c_id)
+        return _measurement in self.measurements
+
+    def lookup(self, c_id, _field=None):
+        """
+        Return the last datapoint of a station like queries.load_last_datapoint(),
+        i.e. a DataFrame with a single row (or empty if there is no data)
+
+        :param str _field: name of the field, default: main field of the measurement
+        """
+        if _field is None:
+            _measurement, _ = queries.split_compound_index(c_id)
+            _field = helpers.measurement2field(_measurement)
+        table = self._get_tables().get(_field)
+        if table is None or c_id not in table.index:
+            return pd.DataFrame(columns=["_time", "_value", "c_id"])
+        last = table.loc[[c_id]].reset_index(drop=True)
+        # drop the tags of other measurements that are missing for this station
+        missing = [x for x in last.columns if x not in ("_time", "_value", "c_id") and last[x].isna().all()]
+        return last.drop(columns=missing)
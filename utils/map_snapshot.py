@@ -0,0 +1,114 @@
+"""
+Incremental refresh of the map data
+
+A MapDataSnapshot keeps the raw data behind get_map_data() between refreshes.
+On refresh, only datapoints newer than the last seen "_time" of each measurement
+are requested from the InfluxDB. They are merged into the snapshot and the trend
+is recalculated only for the stations that got new data.
+"""
+
+import logging
+import threading
+import pandas as pd
+from datetime import datetime
+from utils import queries, trends, helpers
+from utils.query_executor import concurrent_map
+
+
+def _last_seen(df):
+    # dict measurement -> last "_time" in df
+    if df is None or df.empty:
+        return {}
+    if "aggregate" in df.columns:
+        # pre-aggregated trend data: request the last window again, including its first datapoint,
+        # as it was probably incomplete. The new mean replaces the old one.
+        df = df[df["aggregate"] == "mean"]
+        last = df.groupby("_measurement", observed=True)["_time"].max() - pd.Timedelta(microseconds=1)
+        return {k: v for k, v in last.items() if not pd.isnull(v)}
+    last = df.groupby("_measurement", observed=True)["_time"].max()
+    return {k: v for k, v in last.items() if not pd.isnull(v)}
+
+
+class MapDataSnapshot:
+
+    def __init__(self, measurements, trend_window=3, bucket="sdd", full_refresh_interval_s=86400,
+                 aggregate_every=None):
+        """
+        :param list measurements: measurements to include in the map data
+        :param int trend_window: number of days for the trend calculation
+        :param str bucket: InfluxDB bucket
+        :param int full_refresh_interval_s: do a complete reload after this number of seconds,
+            e.g. to catch late datapoints and revoked webcam consents
+        :param str aggregate_every: resolution of the trend data, see queries.load_trend_data()
+        """
+        self.measurements = list(measurements)
+        self.trend_window = trend_window
+        self.bucket = bucket
+        self.full_refresh_interval_s = full_refresh_interval_s
+        self.aggregate_every = aggregate_every
+        self.geo_tables = None  # output of queries.load_geo_data()
+        self.trend_data = None  # output of queries.load_trend_data()
+        self.trends = None  # output of trends.calc_trends()
+        self.map_data = None
+        self.last_full_refresh = None
+        self._lock = threading.Lock()
+
+    def refresh(self, query_api):
+        """
+        Update the snapshot and return the new map data
+        """
+        with self._lock:
+            now = datetime.now()
+            if self.map_data is None or \
+                    (now - self.last_full_refresh).total_seconds() > self.full_refresh_interval_s:
+                self._full_refresh(query_api)
+                self.last_full_refresh = now
+            else:
+                self._delta_refresh(query_api)
+            self.map_data = queries.build_map_data(self.geo_tables, self.trends)
+            return self.map_data
+
+    def _full_refresh(self, query_api):
+        logging.debug("Full refresh of map data snapshot")
+        self.geo_tables, self.trend_data = concurrent_map(query_api, lambda load: load(), [
+            lambda: queries.load_geo_data(query_api, self.measurements, bucket=self.bucket),
+            lambda: queries.load_trend_data(query_api, self.measurements, self.trend_window,
+                                            bucket=self.bucket, aggregate_every=self.aggregate_every)])
+        self.trends = trends.calc_trends(self.trend_data, self.trend_window)
+
+    def _delta_refresh(self, query_api):
+        now = pd.Timestamp.now(tz=helpers.local_tz)
+
+        new_geo, new_data = concurrent_map(query_api, lambda load: load(), [
+            lambda: queries.load_geo_data(query_api, self.measurements, bucket=self.bucket,
+                                          since=_last_seen(self.geo_tables)),
+            lambda: queries.load_trend_data(query_api, self.measurements, self.trend_window, bucket=self.bucket,
+                                            since=_last_seen(self.trend_data), aggregate_every=self.aggregate_every)])
+
+        # lat/lon and metadata
+        geo_tables = pd.concat([self.geo_tables, new_geo], ignore_index=True, sort=False)
+        geo_tables = geo_tables.sort_values(by="_time")
+        geo_tables = geo_tables.drop_duplicates(subset=[x for x in geo_tables.columns if x != "_time"], keep="last")
+        geo_tables = geo_tables[geo_tables["_time"] >= now - pd.Timedelta(days=queries.GEO_DAYS)]
+        self.geo_tables = geo_tables.reset_index(drop=True)
+
+        # trend data
+        trend_data = pd.concat([self.trend_data, new_data], ignore_index=True, sort=False)
+        if self.aggregate_every is not None:
+            trend_data = trend_data.drop_duplicates(subset=["c_id", "_time", "aggregate"], keep="last")
+        outdated = trend_data["_time"] < now - pd.Timedelta(days=self.trend_window + 2)
+        changed = set(new_data["c_id"]) | set(trend_data.loc[outdated, "c_id"])
+        trend_data = trend_data[~outdated].reset_index(drop=True)
+        trend_data = trend_data.astype({"c_id": "category", "_measurement": "category"})
+        self.trend_data = trend_data
+        logging.debug(f"Delta refresh of map data snapshot: {len(new_geo)} new geo rows, "
+                      f"{len(new_data)} new datapoints, {len(changed)} stations changed")
+
+        # recalculate the trend only for stations with new (or removed) data
+        if changed:
+            changed_data = trend_data[trend_data["c_id"].isin(changed)]
+            changed_trends = trends.calc_trends(changed_data, self.trend_window)
+            for key in self.trends:
+                for c_id in changed:
+                    self.trends[key].pop(c_id, None)
+                self.trends[key].update(changed_trends[key])
@@ -1,21 +1,21 @@
-import json
+"""
+The traces are built from fragments per measurement, so that the traces for any
+selection of measurements can be assembled without recalculating them:
+    - the scattermapbox trace of the stations
+    - partial sums and counts of the trends per region, the choropleth of several
+      measurements is the combination of their partials
+    - scattermapbox traces of the station clusters per zoom level (see clusters.py)
+    - the traces of the stations and of the clusters from CULL_MIN_ZOOM on, split
+      into map tiles for the viewport culling
+"""
+
 import numpy as np
 import pandas as pd
-from utils import helpers
-import plotly.graph_objects as go
-
+from utils import helpers, geometry, clusters
 
-def get_map_traces(map_data, measurements):
-    """
-    Prepare traces for the map Graph depending on the level of
-    detail: "station", "landkreis", "bundesland"
 
-    :param geopandas.GeoDataFrame map_data: map_data GeoDataFrame
-    :param list measurements: list of measurements to include
-    :return dict: dict of traces for plotting
-    """
-    traces = dict()
-    traces["stations"] = [dict(
+def radius_trace():
+    return dict(
         # TRACE 0: radius selection marker
         name="Filter radius",
         type="scattermapbox",
@@ -29,63 +29,247 @@ def get_map_traces(map_data, measurements):
         lat=[],
         lon=[],
         mode="lines"
-        )]
+        )
 
-    for measurement in measurements:
-        measurement_map_data = map_data[map_data["_measurement"] == measurement]
 
-        # geodataseries as return (lat, lon,...) can cause issues, convert to dataframe:
-        measurement_map_data = pd.DataFrame(measurement_map_data)
+def station_trace(measurement_map_data, measurement):
+    """
+    Scattermapbox trace of the stations of a measurement
 
-        trace = dict(
-            # TRACE 1...N: Datapoints
+    :param pandas.DataFrame measurement_map_data: map_data of this measurement
+    :param str measurement: measurement name
+    """
+    return dict(
+        # TRACE 1...N: Datapoints
+        _measurement=measurement,  # custom entry
+        name=helpers.measurementtitles[measurement],
+        type="scattermapbox",
+        lat=list(measurement_map_data["lat"]),
+        lon=list(measurement_map_data["lon"]),
+        mode='markers',
+        marker=dict(
+            size=20,
+            color=[helpers.trend2color(x) for x in measurement_map_data["trend"]],
+            line=dict(width=2,
+                      color='DarkSlateGrey'),
+        ),
+        text=helpers.tooltiptext(measurement_map_data, mode="stations") if not measurement_map_data.empty else [],
+        hoverinfo="text",
+        customdata=list(measurement_map_data["c_id"])
+    )
+
+
+def cluster_traces(measurement_map_data, measurement, station_text):
+    """
+    Scattermapbox traces of the station clusters of a measurement
+
+    :param pandas.DataFrame measurement_map_data: map_data of this measurement
+    :param str measurement: measurement name
+    :param list station_text: tooltips of the stations, used for clusters with a single station
+    :return dict: zoom level -> trace
+    """
+    lat, lon, trend = measurement_map_data["lat"], measurement_map_data["lon"], measurement_map_data["trend"]
+    c_ids = list(measurement_map_data["c_id"])
+    index = clusters.GridIndex(lat, lon)
+    traces = {}
+    for zoom in range(clusters.MIN_CLUSTER_ZOOM, clusters.MAX_CLUSTER_ZOOM + 1):
+        df = index.clusters(zoom, lat, lon, trend)
+        single = df["count"] == 1
+        traces[zoom] = dict(
             _measurement=measurement,  # custom entry
             name=helpers.measurementtitles[measurement],
             type="scattermapbox",
-            lat=list(measurement_map_data["lat"]),
-            lon=list(measurement_map_data["lon"]),
+            lat=list(df["lat"]),
+            lon=list(df["lon"]),
             mode='markers',
             marker=dict(
-                size=20,
-                color=list(measurement_map_data.apply(lambda x: helpers.trend2color(x["trend"]), axis=1)),
+                # larger markers for larger clusters, single stations as in station_trace()
+                size=list(np.minimum(20 + 6 * np.log2(df["count"]), 44).round(1)),
+                color=[helpers.trend2color(x) for x in df["trend"]],
                 line=dict(width=2,
                           color='DarkSlateGrey'),
             ),
-            text=helpers.tooltiptext(measurement_map_data, mode="stations"),
+            text=[station_text[first] if is_single else helpers.cluster_tooltiptext(count, trend)
+                  for first, is_single, count, trend in zip(df["first"], single, df["count"], df["trend"])],
             hoverinfo="text",
-            customdata=list(measurement_map_data["c_id"])
+            # only single stations can be clicked for their timeline
+            customdata=[c_ids[first] if is_single else None for first, is_single in zip(df["first"], single)]
         )
-        traces["stations"].append(trace)
+    return traces
 
-    # Prepare landkreis choropleth maps
-    region = "landkreis"
-    if map_data.empty:
-        traces[region] = [go.Choroplethmapbox()]
-        return traces
-    choropleth_df_original = map_data.copy()
-    choropleth_df_original = choropleth_df_original[choropleth_df_original["_measurement"].isin(measurements)]
 
-    choropleth_df = choropleth_df_original.copy()
-    # if region == "bundesland":
-    #     choropleth_df["ags"] = choropleth_df["ags"].str[:-3]
-    #     geojson_filename = "states.json"
-    geojson_filename = "counties.json"
-    choropleth_df = choropleth_df.groupby(["ags", region]).agg(["mean", "size"]).reset_index()
-    with open(f"utils/geofeatures-ags-germany/{geojson_filename}", "r") as f:
-        geojson = json.load(f)
-    # noinspection PyTypeChecker
-    traces[region] = [go.Choroplethmapbox(
-        geojson=geojson,
-        locations=choropleth_df["ags"],
-        z=choropleth_df["trend"]["mean"],
+def split_trace(trace):
+    """
+    Scattermapbox trace split into the map tiles of its points (see clusters.tile_keys())
+
+    :return dict: tile -> trace with the points in this tile
+    """
+    positions = {}
+    for i, tile in enumerate(clusters.tile_keys(trace["lat"], trace["lon"])):
+        if tile is not None:
+            positions.setdefault(tile, []).append(i)
+    tiles = {}
+    for tile, idx in positions.items():
+        tiles[tile] = dict(trace, **{x: [trace[x][i] for i in idx] for x in ("lat", "lon", "text", "customdata")})
+        tiles[tile]["marker"] = dict(trace["marker"], **{x: [trace["marker"][x][i] for i in idx]
+                                                         for x in ("color", "size")
+                                                         if isinstance(trace["marker"].get(x), list)})
+    return tiles
+
+
+def tiled_traces(stations, cluster_traces_by_zoom):
+    """
+    Tiles of the traces that are culled to the viewport
+
+    :return dict: "stations" or zoom level -> tile -> trace
+    """
+    tiles = {"stations": split_trace(stations)}
+    for zoom in range(clusters.CULL_MIN_ZOOM, clusters.MAX_CLUSTER_ZOOM + 1):
+        tiles[zoom] = split_trace(cluster_traces_by_zoom[zoom])
+    return tiles
+
+
+def choropleth_partials(measurement_map_data, region="landkreis"):
+    """
+    Partial aggregates of the trend per region, see combine_choropleth()
+
+    :return pandas.DataFrame: columns ags, region, trend_sum, trend_count (stations with a trend)
+        and size (all stations)
+    """
+    df = pd.DataFrame(measurement_map_data[["ags", region, "trend"]])
+    df["trend_count"] = df["trend"].notna().astype(int)
+    df["trend"] = df["trend"].fillna(0)
+    partials = df.groupby(["ags", region], observed=True).agg(
+        trend_sum=("trend", "sum"),
+        trend_count=("trend_count", "sum"),
+        size=("trend", "size"))
+    return partials.reset_index()
+
+
+def get_trace_fragment(map_data, measurement, region="landkreis"):
+    """
+    Station trace and choropleth partials of a single measurement
+
+    :param geopandas.GeoDataFrame map_data: map_data GeoDataFrame
+    :param str measurement: measurement name
+    :return dict: "stations": trace, "clusters": dict zoom level -> trace, "tiles": see tiled_traces(),
+        region: partials
+    """
+    measurement_map_data = map_data[map_data["_measurement"] == measurement]
+    # geodataseries as return (lat, lon,...) can cause issues, convert to dataframe:
+    measurement_map_data = pd.DataFrame(measurement_map_data)
+    stations = station_trace(measurement_map_data, measurement)
+    station_clusters = cluster_traces(measurement_map_data, measurement, stations["text"])
+    return {
+        "stations": stations,
+        "clusters": station_clusters,
+        "tiles": tiled_traces(stations, station_clusters),
+        region: choropleth_partials(measurement_map_data, region),
+    }
+
+
+def choropleth_style():
+    # attributes of the choropleth trace that do not depend on the data
+    return dict(
+        type="choroplethmapbox",
         showlegend=False,
         showscale=False,
         colorscale=[helpers.trend2color(x) for x in np.linspace(-1, 2, 10)],
         hoverinfo="text",
         zmin=-1,
         zmax=2,
-        text=helpers.tooltiptext(choropleth_df, mode=region),
-        marker_line_color="white",
-        marker_opacity=1,
-        marker_line_width=1)]
-    return traces
+        marker=dict(line=dict(color="white", width=1), opacity=1))
+
+
+def combine_choropleth(partials, region="landkreis", zoom=None):
+    """
+    Choropleth trace of the mean trend per region from the partials of several measurements
+
+    :param float zoom: zoom level of the map for the resolution of the geometries, see geometry.py
+    """
+    partials = [x for x in partials if not x.empty]
+    if not partials:
+        return dict(type="choroplethmapbox")
+    combined = pd.concat(partials, ignore_index=True).groupby(["ags", region]).sum().reset_index()
+    mean = combined["trend_sum"] / combined["trend_count"].where(combined["trend_count"] > 0)
+    return dict(
+        choropleth_style(),
+        geojson=geometry.region_geojson(region, combined["ags"], zoom),
+        locations=list(combined["ags"]),
+        z=list(mean),
+        text=[helpers.region_tooltiptext(name, trend, size)
+              for name, trend, size in zip(combined[region], mean, combined["size"])])
+
+
+def assemble_map_traces(fragments, region="landkreis", zoom=None):
+    """
+    Traces for the map Graph from the fragments of the selected measurements
+
+    :param list fragments: outputs of get_trace_fragment(), in the order of the traces
+    :param float zoom: zoom level of the map, also for the station clusters
+    :return dict: dict of traces for plotting
+    """
+    level = clusters.cluster_level(zoom)
+    return {
+        "stations": [radius_trace()] + [x["stations"] if level is None else x["clusters"][level] for x in fragments],
+        region: [combine_choropleth([x[region] for x in fragments], region, zoom)],
+    }
+
+
+def client_fragment(fragment, region="landkreis"):
+    """
+    Fragment of a measurement in a JSON-compatible form, see client_data().
+    The single stations and the clusters from CULL_MIN_ZOOM on are only included as tiles.
+    """
+    partials = fragment[region]
+    return dict(
+        clusters={k: v for k, v in fragment["clusters"].items() if k < clusters.CULL_MIN_ZOOM},
+        tiles=fragment["tiles"],
+        regions=dict(ags=partials["ags"].astype(str).tolist(),
+                     name=partials[region].astype(str).tolist(),
+                     sum=partials["trend_sum"].tolist(),
+                     count=partials["trend_count"].tolist(),
+                     size=partials["size"].tolist()))
+
+
+def client_data(fragments, measurements, region="landkreis"):
+    """
+    Data for the clientside assembly of the map figure (see assets/map_figure.js):
+    the fragments in a JSON-compatible form, the geometries are stored separately
+
+    :param list fragments: outputs of get_trace_fragment()
+    :param list measurements: measurements of the fragments
+    """
+    client_fragments = [client_fragment(x, region) for x in fragments]
+    return dict(
+        clusters={m: x["clusters"] for m, x in zip(measurements, client_fragments)},
+        tiles={m: x["tiles"] for m, x in zip(measurements, client_fragments)},
+        regions={m: x["regions"] for m, x in zip(measurements, client_fragments)},
+        **client_settings())
+
+
+def client_settings():
+    # parts of the client data that do not depend on the data
+    return dict(
+        radius=radius_trace(),
+        choropleth=choropleth_style(),
+        cluster_zoom=[clusters.MIN_CLUSTER_ZOOM, clusters.MAX_CLUSTER_ZOOM],
+        cull_zoom=clusters.CULL_MIN_ZOOM,
+        tile_zoom=clusters.TILE_ZOOM,
+        zoom_tolerances=geometry.ZOOM_TOLERANCES)
+
+
+def get_map_traces(map_data, measurements, zoom=None):
+    """
+    Prepare traces for the map Graph depending on the level of
+    detail: "station", "landkreis", "bundesland"
+
+    :param geopandas.GeoDataFrame map_data: map_data GeoDataFrame
+    :param list measurements: list of measurements to include
+    :param float zoom: zoom level of the map
+    :return dict: dict of traces for plotting
+    """
+    # if region == "bundesland":
+    #     choropleth_df["ags"] = choropleth_df["ags"].str[:-3]
+    #     geojson_filename = "states.json"
+    return assemble_map_traces([get_trace_fragment(map_data, x) for x in measurements], zoom=zoom)
@@ -3,13 +3,13 @@ utility functions for the frontend that query the InfluxDB
 for cached version of these functions, see cached_functions.py
 """
 import pandas as pd
-import numpy as np
 import geopandas as gpd
 from influxdb_client import InfluxDBClient
 import json
 import logging
-from utils import helpers
-from datetime import timedelta, datetime
+from utils import helpers, ingest, rollups, trends
+from utils.query_executor import QueryExecutor, concurrent_map
+from datetime import datetime
 
 
 def get_query_api(url, org, token):
@@ -19,10 +19,14 @@ def get_query_api(url, org, token):
 
 
 def get_query_api_from_config(CONFIG):
+    # pooled query executor, see query_executor.py
     url = CONFIG["influx_url"]
     org = CONFIG["influx_org"]
     token = CONFIG["influx_token"]
-    return get_query_api(url, org, token)
+    return QueryExecutor(url, org, token,
+                         timeout_s=CONFIG.get("INFLUX_TIMEOUT_S", 30),
+                         retries=CONFIG.get("INFLUX_RETRIES", 2),
+                         max_workers=CONFIG.get("INFLUX_MAX_WORKERS", 8))
 
 
 CID_SEP = "$"  # separator symbol for compound index
@@ -30,7 +34,7 @@ CID_SEP = "$"  # separator symbol for compound index
 
 def compound_index(df):
     # make compound index
-    return df.apply(lambda x: x["_measurement"] + CID_SEP + str(x["_id"]), axis=1)
+    return df["_measurement"].astype(str) + CID_SEP + df["_id"].astype(str)
 
 
 def split_compound_index(c_id):
@@ -39,22 +43,86 @@ def split_compound_index(c_id):
     return _measurement, _id
 
 
-def get_map_data(query_api, measurements, trend_window=3, bucket="sdd"):
+MAP_DATA_COLUMNS = ['c_id', 'lat', 'lon', 'geometry',
+                    '_id', '_measurement', 'ags', 'bundesland',
+                    'city', 'districtType', 'landkreis', 'name',
+                    'origin', 'trend', 'model', 'last_value',
+                    'last_time', 'landkreis_label']
+GEO_DAYS = 10  # stations without a lat/lon datapoint in this number of days are not shown
+
+
+def flux_time(timestamp):
+    # Flux time literal for a timezone aware timestamp
+    return f'time(v: "{timestamp.tz_convert("UTC").strftime("%Y-%m-%dT%H:%M:%S.%fZ")}")'
+
+
+def flux_measurement_filter(measurements, since=None):
+    """
+    Flux filter expression for a list of measurements
+    since: optional dict measurement -> timestamp. Only data newer than this
+    timestamp is requested for the measurement.
+    """
+    if not since:
+        return f'contains(value: r["_measurement"], set: {json.dumps(list(measurements))})'
+    conditions = []
+    for _measurement in measurements:
+        if _measurement in since:
+            conditions.append(f'(r["_measurement"] == "{_measurement}" and r["_time"] > {flux_time(since[_measurement])})')
+        else:
+            conditions.append(f'r["_measurement"] == "{_measurement}"')
+    return " or ".join(conditions)
+
+
+def flux_range_start(days, measurements, since=None):
+    # start of the range() call: the oldest timestamp in since or -{days}d
+    if not since or any(x not in since for x in measurements):
+        return f"-{days}d"
+    return flux_time(min(since[x] for x in measurements))
+
+
+def filter_active_events(df):
+    # remove inactive events (writeapi), i.e. the current time is not between start_date and end_date
+    now = datetime.now()
+    df = df.copy()
+    df["start_date"] = pd.to_datetime(df["start_date"])
+    df["end_date"] = pd.to_datetime(df["end_date"])
+    df = df[df["end_date"] >= now]
+    df = df[df["start_date"] <= now]
+    return df
+
+
+def get_map_data(query_api, measurements, trend_window=3, bucket="sdd", batched=True, aggregate_every=None):
     """
     Load the data that is required for plotting the map.
     Return a GeoDataFrame with all tags and latitude/longitude fields and the trend
+
+    With batched=True, the lat/lon/metadata of all measurements are requested with
+    a single Flux query. Otherwise, one query per measurement is sent.
+    aggregate_every: resolution of the data for the trend calculation, see load_trend_data()
     """
     # noinspection PySimplifyBooleanCheck
     if measurements == []:
         # nothing selected? return empty dataframe with all the columns
-        return pd.DataFrame(columns=['c_id', 'lat', 'lon', 'geometry',
-                                     '_id', '_measurement', 'ags', 'bundesland',
-                                     'city', 'districtType', 'landkreis', 'name',
-                                     'origin', 'trend', 'model', 'last_value',
-                                     'last_time', 'landkreis_label'])
+        return pd.DataFrame(columns=MAP_DATA_COLUMNS)
     logging.debug("Influx DB query for get_map_data()")
+    # the two queries are independent and run in parallel
+    tables, trenddict = concurrent_map(query_api, lambda load: load(), [
+        lambda: load_geo_data(query_api, measurements, bucket=bucket, batched=batched),
+        lambda: load_trend(query_api, measurements, trend_window, bucket=bucket, aggregate_every=aggregate_every)])
+    return build_map_data(tables, trenddict)
+
+
+def load_geo_data(query_api, measurements, bucket="sdd", batched=True, since=None):
+    """
+    Load the lat/lon fields and the metadata tags of all stations
+
+    Returns a DataFrame with one row per station, field and value. The "_time"
+    column holds the last time this row was seen.
+    since: optional dict measurement -> timestamp, to request only newer data
+    """
     fields = ["_field",
               "_value",
+              "_time",
               "_id",
               "_measurement",
               "name",
@@ -67,52 +135,94 @@ def get_map_data(query_api, measurements, trend_window=3, bucket="sdd"):
               "origin",
               "start_date",
               "end_date"]
-    tables = pd.DataFrame()
     required_columns = {"_id", "ags", "bundesland", "districtType", "landkreis", "name", "origin"}
-    for _measurement in measurements:
+    if batched:
+        # one query for all measurements, split up locally afterwards
         query = f'''
         from(bucket: "{bucket}")
-        |> range(start: -10d) 
+        |> range(start: {flux_range_start(GEO_DAYS, measurements, since)})
         |> filter(fn: (r) => r["_field"] == "lon" or r["_field"] == "lat")
-        |> filter(fn: (r) => r["_measurement"] == "{_measurement}")
+        |> filter(fn: (r) => {flux_measurement_filter(measurements, since)})
         |> filter(fn: (r) => r["unverified"] != "True")
         |> group(columns:["lat", "lon"])
         |> keep(columns: {json.dumps(fields)})
         '''
         try:
-            logging.debug(f" Influx query for {_measurement}...")
-            influx_table = query_api.query_data_frame(query)
+            logging.debug(f" Influx query for {measurements}...")
+            influx_table = ingest.query_frame(query_api, query)
         except:
             print("Error fetching data from influxdb")
             print(query)
-            continue
-        influx_table.drop_duplicates(inplace=True)
+            influx_table = pd.DataFrame()
+        if "_measurement" in influx_table.columns:
+            measurement_tables = [(_measurement, influx_table[influx_table["_measurement"] == _measurement])
+                                  for _measurement in measurements]
+        else:
+            measurement_tables = []
+    else:
+        def load_measurement(_measurement):
+            query = f'''
+            from(bucket: "{bucket}")
+            |> range(start: {flux_range_start(GEO_DAYS, [_measurement], since)})
+            |> filter(fn: (r) => r["_field"] == "lon" or r["_field"] == "lat")
+            |> filter(fn: (r) => {flux_measurement_filter([_measurement], since)})
+            |> filter(fn: (r) => r["unverified"] != "True")
+            |> group(columns:["lat", "lon"])
+            |> keep(columns: {json.dumps(fields)})
+            '''
+            try:
+                logging.debug(f" Influx query for {_measurement}...")
+                return _measurement, ingest.query_frame(query_api, query)
+            except:
+                print("Error fetching data from influxdb")
+                print(query)
+                return None
+
+        # one query per measurement, in parallel
+        measurement_tables = [x for x in concurrent_map(query_api, load_measurement, measurements) if x is not None]
+
+    tables = []
+    for _measurement, influx_table in measurement_tables:
+        # keep only the last occurrence of every row
+        influx_table = influx_table.sort_values(by="_time")
+        influx_table = influx_table.drop_duplicates(subset=[x for x in influx_table.columns if x != "_time"],
+                                                    keep="last")
+        # columns that are empty for this measurement are artifacts of the batched query
+        influx_table = influx_table.dropna(axis=1, how="all")
 
         columns = set(influx_table.columns)
         if not required_columns.issubset(columns):
-            missing = required_columns.difference(columns)
-            print(f"Missing columns for {_measurement}: {missing}")
-            logging.warning(f"Missing columns for {_measurement}: {missing}")
+            if since is None:
+                missing = required_columns.difference(columns)
+                print(f"Missing columns for {_measurement}: {missing}")
+                logging.warning(f"Missing columns for {_measurement}: {missing}")
             continue
 
         if _measurement == "webcam-customvision":
             influx_table = helpers.filter_by_consent(influx_table)
-        elif _measurement == "writeapi":
-            now = datetime.now()
-            influx_table["start_date"] = pd.to_datetime(influx_table["start_date"])
-            influx_table["end_date"] = pd.to_datetime(influx_table["end_date"])
-            # remove inactive events:
-            influx_table = influx_table[influx_table["end_date"] >= now]
-            influx_table = influx_table[influx_table["start_date"] <= now]
         if influx_table.empty:
             continue
 
+        influx_table = ingest.decategorize(influx_table)
         influx_table["c_id"] = compound_index(influx_table)
         influx_table["_value"] = pd.to_numeric((influx_table["_value"]))
-        if tables.empty:
-            tables = influx_table.copy()
-        else:
-            tables = tables.append(influx_table, ignore_index=True)
+        tables.append(influx_table)
+    # concatenate only once, appending in the loop copies the whole frame every time
+    if not tables:
+        return pd.DataFrame(columns=["_field", "_value", "_time", "c_id", "_measurement"])
+    return pd.concat(tables, ignore_index=True, sort=False)
+
+
+def build_map_data(tables, trenddict):
+    """
+    Build the map_data GeoDataFrame from the output of load_geo_data() and load_trend()
+    """
+    is_event = tables["_measurement"] == "writeapi"
+    if is_event.any():
+        # events are filtered here, they may start or end between two refreshes
+        tables = pd.concat([tables[~is_event], filter_active_events(tables[is_event])], ignore_index=True, sort=False)
+    if tables.empty:
+        return pd.DataFrame(columns=MAP_DATA_COLUMNS)
     # pivot table so that the lat/lon fields become named columns
     geo_table = tables[["_field", "_value", "c_id"]]
     geo_table = geo_table.astype({'_value': 'float'})
@@ -121,18 +231,17 @@ def get_map_data(query_api, measurements, trend_window=3, bucket="sdd"):
     geo_table = gpd.GeoDataFrame(geo_table, geometry=gpd.points_from_xy(geo_table.lon, geo_table.lat))
 
     # append metadata (name, ags, bundesland, etc...)
-    metadata = tables.drop(columns=["result", "table", "_value", "_field"], errors="ignore")
+    metadata = tables.drop(columns=["result", "table", "_value", "_field", "_time"], errors="ignore")
     metadata = metadata.set_index("c_id").drop_duplicates()
     geo_table = geo_table.join(metadata)
 
     geo_table = geo_table.reset_index()
     geo_table["ags"] = geo_table["ags"].str.zfill(5)  # 1234 --> "01234"
-    trenddict = load_trend(query_api, measurements, trend_window)
     geo_table["trend"] = geo_table["c_id"].map(trenddict["trend"])
     geo_table["model"] = geo_table["c_id"].map(trenddict["model"])
     geo_table["last_value"] = geo_table["c_id"].map(trenddict["last_value"])
     geo_table["last_time"] = geo_table["c_id"].map(trenddict["last_time"])
-    geo_table["landkreis_label"] = geo_table.apply(lambda x: str(x["landkreis"]) + " " + str(x["districtType"]), 1)
+    geo_table["landkreis_label"] = geo_table["landkreis"].astype(str) + " " + geo_table["districtType"].astype(str)
 
     print("Result of 'get_map_data():")
     print(geo_table.dtypes)
@@ -144,7 +253,7 @@ def get_map_data(query_api, measurements, trend_window=3, bucket="sdd"):
     return geo_table
 
 
-def load_trend(query_api, measurements, trend_window=3, bucket="sdd"):
+def load_trend(query_api, measurements, trend_window=3, bucket="sdd", aggregate_every=None):
     """
     Acquire trend values for all stations
     this is an expensive call, as the data from all stations
@@ -163,113 +272,193 @@ def load_trend(query_api, measurements, trend_window=3, bucket="sdd"):
         (1.234, 5.678)
 
     a and b are the linear regression fit parameters: a=slope, b=offset
+    With aggregate_every (e.g. "1h"), the regression is done on the means per window,
+    which reduces the amount of data that is transferred from the InfluxDB.
 
     """
     print(f"load_trend... (trend_window={trend_window})")
-    logging.debug(f"Influx DB query for load_trend() with trend_window={trend_window}")
+    df = load_trend_data(query_api, measurements, trend_window, bucket, aggregate_every=aggregate_every)
+    return trends.calc_trends(df, trend_window)  # dicts
+
+
+def load_trend_data(query_api, measurements, trend_window=3, bucket="sdd", since=None, aggregate_every=None):
+    """
+    Load the datapoints of all stations required for the trend calculation
+    Returns a DataFrame with the columns c_id, _measurement, _time and _value
+    since: optional dict measurement -> timestamp, to request only newer data
+    aggregate_every: optional Flux duration, e.g. "1h". The datapoints are reduced to
+    the mean of each window by the InfluxDB. Then, the last datapoint of every station
+    is added and the result has an additional column "aggregate" ("mean" or "last")
+    """
+    logging.debug(f"Influx DB query for load_trend_data() with trend_window={trend_window}")
     filterstring = " or ".join([f'r["_field"] == "{helpers.fieldnames[x]}"' for x in measurements])
-    query = f'''
+    columns = ["c_id", "_measurement", "_time", "_value"]
+    data = f'''
             from(bucket: "{bucket}")
-          |> range(start: -{trend_window + 2}d)
+          |> range(start: {flux_range_start(trend_window + 2, measurements, since)})
           |> filter(fn: (r) =>  {filterstring})
+          |> filter(fn: (r) => {flux_measurement_filter(measurements, since)})
           |> filter(fn: (r) => r["unverified"] != "True")
           '''
-    tables = query_api.query_data_frame(query)
-    print("query executed")
-    if isinstance(tables, list):
-        df = pd.concat(tables)
+    if aggregate_every is None:
+        query = data + '''|> keep(columns: ["_time", "_value", "_measurement", "_id"])
+          '''
     else:
-        df = tables
-    df["c_id"] = compound_index(df)
-
-    output = {
-        "model": {},
-        "trend": {},
-        "last_value": {},
-        "last_time": {}
-    }
-    df["_time"] = df["_time"].apply(helpers.utc_to_local, 1)
-    df["unixtime"] = df["_time"].apply(lambda x: int(x.timestamp()), 1)  # unixtime in s
-    for cid in set(df["c_id"]):
-        # get sub-dataframe for this id
-
-        tmpdf = df[df["c_id"] == cid].sort_values(by=["unixtime"])
-        output["last_value"][cid] = tmpdf["_value"].iloc[-1]
-        output["last_time"][cid] = tmpdf["_time"].iloc[-1]
-
-        lastday = max(tmpdf["_time"])
-        firstday = min(tmpdf["_time"])
-
-        if (lastday - firstday).days < trend_window - 1:
-            # not enough data for this station, trend window not covered
-            output["model"][cid] = (np.nan, np.nan)
-            output["trend"][cid] = np.nan
-            continue
+        keep = '''|> keep(columns: ["_time", "_value", "_measurement", "_id", "aggregate"])'''
+        query = f'''
+        data = {data}
+        union(tables: [
+          data
+            |> aggregateWindow(every: {aggregate_every}, fn: mean, createEmpty: false, timeSrc: "_start")
+            |> set(key: "aggregate", value: "mean")
+            {keep},
+          data
+            |> last()
+            |> toFloat()
+            |> set(key: "aggregate", value: "last")
+            {keep}
+        ])
+        '''
+        columns.append("aggregate")
+    df = ingest.query_frame(query_api, query)
+    print("query executed")
+    if df.empty:
+        return pd.DataFrame(columns=columns)
+    df["c_id"] = compound_index(df).astype("category")
+    return df[columns]
 
-        day0 = lastday - timedelta(days=trend_window - 1)
-        tmpdf = tmpdf[tmpdf["_time"] >= day0]
-        tmpdf = tmpdf.reset_index(drop=True)
-
-        values = pd.to_numeric(tmpdf["_value"])
-
-        COUNT_LOW_THRESHOLD = 3
-        PERCENT_NONZEROS_THRESHOLD = 0.75
-        # perform linear regression only when the mean is above COUNT_LOW_THRESHOLD
-        # or if the fraction of non-zero numbers exceeds PERCENT_NONZEROS_THRESHOLD.
-        # This is to suppress unhelpful fits for low-value data sources
-        if np.mean(values) > COUNT_LOW_THRESHOLD or \
-                np.count_nonzero(values) / len(values) > PERCENT_NONZEROS_THRESHOLD:
-            # linear regression y = a*x +b
-            model = np.polyfit(tmpdf["unixtime"], values, 1)
-            output["model"][cid] = model
-
-            # calculate trend
-            a, b = model[:2]
-            t1 = day0.timestamp()
-            t2 = lastday.timestamp()
-            y1 = (a * t1 + b)
-            y2 = (a * t2 + b)
-            if y1 > 0:
-                output["trend"][cid] = y2 / y1 - 1
-            else:
-                output["trend"][cid] = np.nan
-        else:
-            # counts too low for reliable regression
-            output["model"][cid] = (np.nan, np.nan)
-            output["trend"][cid] = np.nan
 
-    return output  # dicts
+def _add_rolling(tables):
+    # 3 day rolling average
+    tables = tables.sort_values(by="_time")
+    tables["rolling"] = tables.set_index("_time")["_value"].rolling("3d").mean().values
+    return tables
 
 
-def load_timeseries(query_api, c_id, daysback=90, bucket="sdd"):
+def timeseries_filter(c_ids):
+    """
+    Flux filter expression for the main field of the stations in c_ids
+    """
+    ids_by_measurement = {}
+    for c_id in c_ids:
+        _measurement, _id = split_compound_index(c_id)
+        ids_by_measurement.setdefault(_measurement, []).append(_id)
+    return " or ".join([
+        f'(r["_measurement"] == "{_measurement}" and r["_field"] == "{helpers.measurement2field(_measurement)}" '
+        f'and contains(value: r["_id"], set: {json.dumps(_ids)}))'
+        for _measurement, _ids in ids_by_measurement.items()])
+
+
+def raw_timeseries_flux(source_filter, start, stop=None, bucket="sdd"):
+    """
+    Flux query for the raw datapoints selected by source_filter, as used by
+    load_timeseries() and to fill the local archive (see archive.py)
+
+    :param str start: Flux time expression, e.g. "-90d" or flux_time(...)
+    :param str stop: Flux time expression or None for now
+    """
+    stop = f", stop: {stop}" if stop is not None else ""
+    return f'''
+        from(bucket: "{bucket}")
+          |> range(start: {start}{stop})
+          |> filter(fn: (r) => {source_filter})
+          |> filter(fn: (r) => r["unverified"] != "True")
+          |> keep(columns: ["_time", "_value", "_measurement", "_id"])
+          '''
+
+
+def load_timeseries(query_api, c_id, daysback=90, bucket="sdd", tier="auto", rollup_buckets=None,
+                    archive=None, hot_days=90, sampling_intervals=None):
     """
     Load time series for a given compound index
+
+    tier: "raw", "1h", "1d" or "auto". With "auto", the tier is selected depending on
+    daysback and the sampling interval of the measurement, see rollups.select_tier(),
+    and the last rollups.RAW_DAYS are read from the raw data. For the rollup tiers,
+    _value is the mean and there is an additional column count (NaN for the raw datapoints).
+    rollup_buckets: dict tier -> bucket with precomputed rollups, see rollups.rollup_flux()
+    archive: optional archive.TimeseriesArchive. If daysback is larger than hot_days,
+    the part of the range older than hot_days is read from the archive instead of the InfluxDB
+    sampling_intervals: dict measurement -> interval of the raw datapoints, default rollups.SAMPLING_INTERVALS
     """
-    logging.debug(f"Influx DB query for load_timeseries(..., {c_id})")
-    print("load_timeseries", c_id)
-    _measurement, _id = split_compound_index(c_id)
-    _field = helpers.measurement2field(_measurement)
-    query = f'''
-    from(bucket: "{bucket}")
-      |> range(start: -{daysback}d) 
-      |> filter(fn: (r) => r["_measurement"] == "{_measurement}")
-      |> filter(fn: (r) => r["_field"] == "{_field}")
-      |> filter(fn: (r) => r["_id"] == "{_id}")
-      |> filter(fn: (r) => r["unverified"] != "True")
-      '''
-    tables = query_api.query_data_frame(query)
-    if isinstance(tables, list):
-        tables = pd.concat(tables)
-        tables = tables.sort_values(by="_time", axis=0)
-    assert isinstance(tables, pd.DataFrame), \
-        f"Warning: tables type is not DataFrame but {type(tables)} (load_timeseries)"
+    return load_timeseries_many(query_api, [c_id], daysback, bucket, tier, rollup_buckets, archive, hot_days,
+                                sampling_intervals)[c_id]
+
+
+def load_timeseries_many(query_api, c_ids, daysback=90, bucket="sdd", tier="auto", rollup_buckets=None,
+                         archive=None, hot_days=90, sampling_intervals=None):
+    """
+    Load time series for several compound indices with a single query (one per tier
+    if "auto" selects different tiers for their measurements)
+    Returns a dict c_id -> DataFrame like load_timeseries() (or None if there is no data)
+    """
+    logging.debug(f"Influx DB query for load_timeseries_many(..., {c_ids})")
+    if tier != "auto":
+        return _load_timeseries_tier(query_api, c_ids, daysback, bucket, tier, rollup_buckets, archive, hot_days)
+    if sampling_intervals is None:
+        sampling_intervals = rollups.SAMPLING_INTERVALS
+    c_ids_by_tier = {}
+    for c_id in c_ids:
+        sampling_interval = sampling_intervals.get(split_compound_index(c_id)[0])
+        c_ids_by_tier.setdefault(rollups.select_tier(daysback, sampling_interval), []).append(c_id)
+    output = {c_id: None for c_id in c_ids}
+    for tier, tier_c_ids in c_ids_by_tier.items():
+        output.update(_load_timeseries_tier(query_api, tier_c_ids, daysback, bucket, tier, rollup_buckets, archive,
+                                            hot_days, raw_days=rollups.RAW_DAYS))
+    return output
+
+
+def _load_timeseries_tier(query_api, c_ids, daysback, bucket, tier, rollup_buckets, archive, hot_days,
+                          raw_days=None):
+    # time series of a single tier, the last raw_days from the raw data
+    output = {c_id: None for c_id in c_ids}
+    if not c_ids:
+        return output
+    recent = None  # start of the raw datapoints after the rollups
+    if tier != "raw" and raw_days:
+        recent = pd.Timestamp.now(tz="UTC") - pd.Timedelta(days=raw_days)
+        recent = recent.floor(rollups.PANDAS_WINDOWS[tier])
+    filterstring = timeseries_filter(c_ids)
+    start = f"-{daysback}d"
+    archived = None
+    if archive is not None and daysback > hot_days:
+        # cold part of the range from the archive, split at a window boundary of the tier
+        now = pd.Timestamp.now(tz="UTC")
+        split = now - pd.Timedelta(days=hot_days)
+        if tier != "raw":
+            split = split.floor(rollups.PANDAS_WINDOWS[tier])
+        archived = archive.read(c_ids, now - pd.Timedelta(days=daysback), split)
+        start = flux_time(split)
+    if tier == "raw":
+        query = raw_timeseries_flux(filterstring, start, bucket=bucket)
+    else:
+        query = rollups.rollup_flux(filterstring, daysback, tier, bucket, rollup_buckets, start=start,
+                                    stop=None if recent is None else flux_time(recent))
+    tables = ingest.query_frame(query_api, query)
+    if not tables.empty:
+        tables["c_id"] = compound_index(tables)
+        if tier != "raw":
+            tables = rollups.pivot_rollups(tables)
+    if recent is not None:
+        raw = ingest.query_frame(query_api, raw_timeseries_flux(filterstring, flux_time(recent), bucket=bucket))
+        if not raw.empty:
+            raw["c_id"] = compound_index(raw)
+            tables = pd.concat([tables, raw[["c_id", "_time", "_value"]]], ignore_index=True, sort=False)
+    if archived is not None and not archived.empty:
+        archived["c_id"] = compound_index(archived)
+        if tier != "raw":
+            # windows in UTC like aggregateWindow()
+            archived = rollups.rollup_frame(archived, tier)
+        archived["_time"] = helpers.series_utc_to_local(archived["_time"])
+        tables = pd.concat([archived, tables], ignore_index=True, sort=False)
     if tables.empty:
-        print(f"Warning: No data for {c_id} (load_timeseries)")
-        return None
-    tables["_time"] = tables["_time"].apply(helpers.utc_to_local, 1)
-    tables = tables.sort_values(by="_time")
-    tables["rolling"] = tables.set_index("_time")["_value"].rolling("3d").mean().values
-    return tables[["_time", "_value", "rolling"]]
+        print(f"Warning: No data for {c_ids} (load_timeseries_many)")
+        return output
+    columns = ["_time", "_value", "rolling"] + [x for x in rollups.AGGREGATES[1:] if x in tables.columns]
+    for c_id, group in tables.groupby("c_id", sort=False):
+        if c_id in output:
+            output[c_id] = _add_rolling(group)[columns]
+    return output
 
 
 def load_last_datapoint(query_api, c_id, bucket="sdd", _field=None):
@@ -287,9 +476,8 @@ def load_last_datapoint(query_api, c_id, bucket="sdd", _field=None):
       |> filter(fn: (r) => r["unverified"] != "True")
       |> last()
       '''
-    tables = query_api.query_data_frame(query)
-    if isinstance(tables, list):
-        tables = pd.concat(tables)
+    tables = ingest.query_frame(query_api, query)
+    if not tables.empty:
         tables = tables.sort_values(by="_time", axis=0)
     last = tables.iloc[-1:].copy()
     last["c_id"] = c_id
@@ -298,3 +486,60 @@ def load_last_datapoint(query_api, c_id, bucket="sdd", _field=None):
     assert isinstance(last, pd.DataFrame), \
         f"Warning: 'last' type is not DataFrame but {type(last)} (load_last_datapoint)"
     return last
+
+
+def load_last_values(query_api, measurements, bucket="sdd", fields=("open",)):
+    """
+    Load the last datapoint of the main field and of the additional fields (e.g. "open")
+    of all stations with a single query
+
+    Returns a DataFrame with one row per c_id and _field, including all tags of the station
+    """
+    logging.debug(f"Influx DB query for load_last_values(..., {measurements})")
+    fieldnames = sorted(set([helpers.measurement2field(x) for x in measurements]) | set(fields))
+    query = f'''
+    from(bucket: "{bucket}")
+      |> range(start: -21d)
+      |> filter(fn: (r) => contains(value: r["_measurement"], set: {json.dumps(list(measurements))}))
+      |> filter(fn: (r) => contains(value: r["_field"], set: {json.dumps(fieldnames)}))
+      |> filter(fn: (r) => r["unverified"] != "True")
+      |> last()
+      '''
+    tables = ingest.query_frame(query_api, query)
+    if tables.empty:
+        return pd.DataFrame(columns=["c_id", "_field", "_time", "_value"])
+    tables = ingest.decategorize(tables)
+    tables["c_id"] = compound_index(tables)
+    # the main field of each measurement and the additional fields
+    main = tables["_field"] == tables["_measurement"].map(helpers.measurement2field)
+    tables = tables[main | tables["_field"].isin(fields)]
+    # a station can have several series (e.g. after a change of its tags): use the newest
+    tables = tables.sort_values(by="_time").drop_duplicates(subset=["c_id", "_field"], keep="last")
+    return tables.reset_index(drop=True)
+
+
+def load_data_versions(query_api, measurements, bucket="sdd", days=3):
+    """
+    Time of the newest datapoint of each measurement, a cheap version of the data.
+    The measurements are filtered with == (unlike contains(), the filter and last()
+    are pushed down to the storage) and only the last days are searched.
+
+    Returns a dict measurement -> time as string, measurements without data in the
+    last days are missing
+    """
+    logging.debug(f"Influx DB query for load_data_versions(..., {measurements})")
+    filterstring = " or ".join([f'r["_measurement"] == {json.dumps(x)}' for x in measurements])
+    query = f'''
+    from(bucket: "{bucket}")
+      |> range(start: -{days}d)
+      |> filter(fn: (r) => {filterstring})
+      |> last()
+      |> keep(columns: ["_measurement", "_time"])
+      |> group(columns: ["_measurement"])
+      |> sort(columns: ["_time"])
+      |> last(column: "_time")
+      '''
+    tables = ingest.query_frame(query_api, query, local_time=False)
+    if tables.empty:
+        return {}
+    return {str(k): str(v) for k, v in zip(tables["_measurement"], tables["_time"])}
@@ -0,0 +1,156 @@
+"""
+Pooled and concurrent execution of InfluxDB queries
+
+QueryExecutor can be used everywhere a QueryApi is expected (see ingest.query_frame()).
+It adds
+    - a connection pool with keep-alive connections that is shared by all threads
+    - a deadline for every query, including the download of the result
+    - bounded retries with exponential backoff for connection errors and 429/5xx responses
+    - map() to run independent queries in parallel on a thread pool
+
+Use concurrent_map() in functions that take a query_api: it falls back to a
+sequential loop for a plain QueryApi.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from influxdb_client import InfluxDBClient
+from influxdb_client.rest import ApiException
+from urllib3.exceptions import HTTPError
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class QueryTimeout(Exception):
+    pass
+
+
+class _DeadlineResponse:
+    """
+    Wraps the streamed HTTP response of query_raw() and stops reading after the deadline
+    """
+
+    def __init__(self, response, deadline):
+        self.response = response
+        self.deadline = deadline
+        self.complete = False
+
+    def __iter__(self):
+        for line in self.response:
+            if time.monotonic() > self.deadline:
+                raise QueryTimeout("Deadline exceeded while reading the query result")
+            yield line
+        self.complete = True
+
+    def close(self):
+        if self.complete:
+            self.response.release_conn()  # keep the connection for the next query
+        else:
+            self.response.close()
+
+
+class QueryExecutor:
+
+    def __init__(self, url, org, token, timeout_s=30, retries=2, backoff_s=0.5, max_workers=8):
+        """
+        :param int timeout_s: deadline for every query in seconds
+        :param int retries: number of retries after a failed request
+        :param float backoff_s: wait time before the first retry, doubled for every further retry
+        :param int max_workers: number of threads of map() and size of the connection pool
+        """
+        self.timeout_s = timeout_s
+        self.retries = retries
+        self.backoff_s = backoff_s
+        # retries are done here, urllib3 would not retry POST requests anyway
+        self.client = InfluxDBClient(url=url, token=token, org=org, timeout=timeout_s * 1000,
+                                     connection_pool_maxsize=max_workers, retries=False)
+        self.query_api = self.client.query_api()
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="influx-query")
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        # everything else is passed through to the QueryApi
+        if name == "query_api":
+            raise AttributeError(name)
+        return getattr(self.query_api, name)
+
+    def query_raw(self, query, timeout_s=None):
+        """
+        Like QueryApi.query_raw(), with deadline and retries
+
+        :param str query: Flux query
+        :param int timeout_s: deadline for this query, default: self.timeout_s
+        """
+        deadline = time.monotonic() + (timeout_s or self.timeout_s)
+        attempt = 0
+        while True:
+            try:
+                return _DeadlineResponse(self.query_api.query_raw(query), deadline)
+            except (ApiException, HTTPError) as e:
+                retryable = not isinstance(e, ApiException) or e.status in RETRY_STATUS
+                wait = self.backoff_s * 2 ** attempt
+                if not retryable or attempt >= self.retries or time.monotonic() + wait > deadline:
+                    raise
+                attempt += 1
+                logging.warning(f"InfluxDB query failed ({e}), retry {attempt}/{self.retries} in {wait}s")
+                time.sleep(wait)
+
+    def map(self, fn, items):
+        """
+        Return [fn(x) for x in items], with the calls running in parallel on the thread pool.
+        Calls from inside the pool run sequentially to avoid waiting for the pool itself.
+        """
+        items = list(items)
+        if getattr(self._local, "in_pool", False) or len(items) < 2:
+            return [fn(x) for x in items]
+        return list(self.pool.map(lambda x: self._run_in_pool(fn, x), items))
+
+    def _run_in_pool(self, fn, item):
+        self._local.in_pool = True
+        try:
+            return fn(item)
+        finally:
+            self._local.in_pool = False
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+        self.client.close()
+
+
+def concurrent_map(query_api, fn, items):
+    """
+    [fn(x) for x in items], in parallel if query_api is a QueryExecutor
+    """
+    if isinstance(query_api, QueryExecutor):
+        return query_api.map(fn, items)
+    return [fn(x) for x in items]
+
+
+if __name__ == '__main__':
+    """
+    Test: retries and parallel execution with a stand-in for the QueryApi
+    """
+
+    class SlowQueryApi:
+        def __init__(self):
+            self.calls = 0
+
+        def query_raw(self, query):
+            self.calls += 1
+            if self.calls == 1:
+                raise ApiException(status=503)
+            time.sleep(0.2)
+            return iter([b"line\n"])
+
+    print("== TEST ==")
+    executor = QueryExecutor("http://localhost:8086", "ec", "token", retries=1, backoff_s=0.01)
+    executor.query_api = SlowQueryApi()
+    assert list(executor.query_raw("query")) == [b"line\n"]
+    assert executor.query_api.calls == 2
+    t0 = time.monotonic()
+    results = concurrent_map(executor, lambda q: list(executor.query_raw(q)), ["a", "b", "c", "d"])
+    print(f"4 queries of 0.2s in {time.monotonic() - t0:.2f}s")
+    assert len(results) == 4 and time.monotonic() - t0 < 0.6
+    executor.close()
@@ -0,0 +1,226 @@
+"""
+Hourly and daily rollups (mean and count) of the station timeseries
+
+Long time ranges are read from an aggregated tier instead of the raw datapoints:
+    raw : ranges up to 14 days
+    1h  : ranges up to 120 days
+    1d  : everything beyond
+The last RAW_DAYS of a range are always read in full resolution, the charts and
+widgets show the last week in detail (see queries.load_timeseries_many()).
+The rollups are precomputed by InfluxDB tasks (see rollup_task_flux()) that write
+into one bucket per tier, e.g. "sdd_1h" and "sdd_1d" (config: ROLLUP_BUCKETS).
+Without rollup buckets, the same aggregation is done by the InfluxDB at query time.
+Only the aggregates that the timeline charts use are requested: the mean, and the
+count of datapoints per window (windows without data are gaps).
+Measurements that are already sampled at the window of a tier or coarser (see
+SAMPLING_INTERVALS) are read from the raw data instead, a rollup would not reduce it.
+
+LocalRollupStore is a local materialization of the same tiers. It is used as
+stand-in for the InfluxDB tasks when testing.
+"""
+
+import json
+import pandas as pd
+
+RAW_DAYS = 14  # most recent days that are never read from a rollup tier
+# name, aggregation window, longest range in days served from this tier (fine to coarse)
+TIERS = [
+    ("raw", None, RAW_DAYS),
+    ("1h", "1h", 120),
+    ("1d", "1d", None),
+]
+AGGREGATES = ["mean", "count"]
+PANDAS_WINDOWS = {"1h": "1h", "1d": "1D"}
+# measurement -> interval of the raw datapoints, for sources that deliver aggregated data
+SAMPLING_INTERVALS = {"hystreet": "1h", "airquality": "1h"}  # pandas frequencies
+
+
+def select_tier(daysback, sampling_interval=None):
+    """
+    Return the name of the tier that fits the requested range: The finest tier that is
+    still allowed for this number of days, i.e. long ranges get the coarse tiers.
+    "raw" if the window of this tier is not longer than sampling_interval (e.g. "1h").
+    """
+    for name, window, max_days in TIERS:
+        if max_days is None or daysback <= max_days:
+            if window is not None and sampling_interval is not None and \
+                    pd.Timedelta(PANDAS_WINDOWS[name]) <= pd.Timedelta(sampling_interval):
+                return "raw"
+            return name
+
+
+def rollup_task_flux(tier, fields, bucket="sdd", org="ec"):
+    """
+    Flux script for an InfluxDB task that writes the rollups of the last two windows
+    of a tier into the bucket "{bucket}_{tier}". The name of the aggregate is stored
+    in the tag "aggregate".
+    Create the task e.g. with "influx task create --file rollup_1h.flux"
+
+    :param str tier: "1h" or "1d"
+    :param list fields: names of the fields to aggregate, see helpers.fieldnames
+    """
+    every = dict((name, window) for name, window, _ in TIERS)[tier]
+    start = f"-{2 * int(every[:-1])}{every[-1]}"  # last two windows, e.g. -2h
+    filterstring = " or ".join([f'r["_field"] == "{x}"' for x in sorted(set(fields))])
+    script = f'''option task = {{name: "rollup_{bucket}_{tier}", every: {every}}}
+
+data = from(bucket: "{bucket}")
+  |> range(start: {start})
+  |> filter(fn: (r) => {filterstring})
+  |> filter(fn: (r) => r["unverified"] != "True")
+'''
+    for aggregate in AGGREGATES:
+        script += f'''
+data
+  |> aggregateWindow(every: {every}, fn: {aggregate}, createEmpty: false, timeSrc: "_start")
+  |> toFloat()
+  |> set(key: "aggregate", value: "{aggregate}")
+  |> to(bucket: "{bucket}_{tier}", org: "{org}")
+'''
+    return script
+
+
+def rollup_flux(source_filter, daysback, tier, bucket="sdd", rollup_buckets=None, start=None, stop=None):
+    """
+    Flux query for the rollups of the series selected by source_filter
+
+    :param str source_filter: Flux filter expression that selects the raw series (measurement, field and id)
+    :param int daysback: range in days
+    :param str tier: "1h" or "1d"
+    :param dict rollup_buckets: tier -> name of the bucket with the precomputed rollups.
+        If the tier is not in there, the rollups are calculated at query time.
+    :param str start: optional Flux time expression for the start of the range, replaces daysback
+    :param str stop: optional Flux time expression for the end of the range, None for now
+    The result has the columns _time, _measurement, _id, aggregate (one of AGGREGATES) and _value
+    """
+    aggregate_filter = " or ".join([f'r["aggregate"] == "{x}"' for x in AGGREGATES])
+    columns = json.dumps(["_time", "_value", "aggregate", "_measurement", "_id"])
+    if start is None:
+        start = f"-{daysback}d"
+    if stop is not None:
+        start = f"{start}, stop: {stop}"
+    if rollup_buckets and tier in rollup_buckets:
+        # precomputed by the tasks from rollup_task_flux()
+        return f'''
+    from(bucket: "{rollup_buckets[tier]}")
+      |> range(start: {start})
+      |> filter(fn: (r) => {source_filter})
+      |> filter(fn: (r) => {aggregate_filter})
+      |> keep(columns: {columns})
+      '''
+    every = dict((name, window) for name, window, _ in TIERS)[tier]
+    aggregations = ",".join([f'''
+      data
+        |> aggregateWindow(every: {every}, fn: {aggregate}, createEmpty: false, timeSrc: "_start")
+        |> toFloat()
+        |> set(key: "aggregate", value: "{aggregate}")
+        |> keep(columns: {columns})''' for aggregate in AGGREGATES])
+    return f'''
+    data = from(bucket: "{bucket}")
+      |> range(start: {start})
+      |> filter(fn: (r) => {source_filter})
+      |> filter(fn: (r) => r["unverified"] != "True")
+    union(tables: [{aggregations}
+    ])
+    '''
+
+
+def pivot_rollups(df):
+    """
+    Long format (one row per aggregate) --> one row per window with the columns
+    c_id, _time, _value (the mean) and count
+    """
+    df = df.pivot_table(index=["c_id", "_time"], columns="aggregate", values="_value", observed=True)
+    df = df.reset_index().rename(columns={"mean": "_value"})
+    df.columns.name = None
+    return df
+
+
+def rollup(df, tier):
+    """
+    Aggregate a raw timeseries (columns _time and _value) into windows of a tier
+    Returns the columns _time, sum and count (windows without data are dropped)
+    """
+    aggregated = df.set_index("_time")["_value"].resample(PANDAS_WINDOWS[tier]).agg(["sum", "count"])
+    aggregated = aggregated[aggregated["count"] > 0]
+    return aggregated.reset_index()
+
+
+def rollup_frame(df, tier):
+    """
+    Aggregate the raw datapoints of several stations (columns c_id, _time and _value)
+    into windows of a tier. Returns the same format as pivot_rollups()
+    """
+    grouped = df.set_index("_time").groupby("c_id", observed=True, sort=False)["_value"]
+    aggregated = grouped.resample(PANDAS_WINDOWS[tier]).agg(AGGREGATES)
+    aggregated = aggregated[aggregated["count"] > 0].reset_index()
+    return aggregated.rename(columns={"mean": "_value"})
+
+
+class LocalRollupStore:
+    """
+    Local materialization of the rollup tiers for every station. Raw data is
+    added with update() and the tiers are read with load(), which returns the same
+    format as queries.load_timeseries() for a rollup tier.
+    """
+
+    def __init__(self):
+        self.tiers = {name: {} for name, window, _ in TIERS if window is not None}
+
+    def update(self, c_id, df):
+        """
+        Add new raw datapoints (columns _time and _value) of a station.
+        Datapoints must not be added twice, windows that already exist are combined.
+        """
+        for tier, stations in self.tiers.items():
+            new = rollup(df, tier)
+            if c_id in stations:
+                combined = pd.concat([stations[c_id], new]).groupby("_time")
+                new = combined.agg({"sum": "sum", "count": "sum"}).reset_index()
+            stations[c_id] = new
+
+    def load(self, c_id, tier, daysback):
+        if c_id not in self.tiers[tier]:
+            return None
+        df = self.tiers[tier][c_id]
+        start = pd.Timestamp.now(tz=df["_time"].dt.tz) - pd.Timedelta(days=daysback)
+        df = df[df["_time"] >= start].copy()
+        df["_value"] = df["sum"] / df["count"]
+        return df[["_time", "_value", "count"]].reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    """
+    Test: rollups from the local store must equal the aggregation of all raw data at once
+    """
+    import numpy as np
+
+    print("== TEST ==")
+    assert select_tier(7) == "raw"
+    assert select_tier(90) == "1h"
+    assert select_tier(365) == "1d"
+    assert select_tier(90, "1h") == "raw" and select_tier(365, "1h") == "1d" and select_tier(365, "1d") == "raw"
+    assert select_tier(90, "10min") == "1h"
+    assert '"min"' not in rollup_flux("true", 90, "1h") and rollup_flux("true", 90, "1h").count("aggregateWindow") == 2
+
+    rng = np.random.default_rng(0)
+    end = pd.Timestamp.now(tz="Europe/Berlin").floor("min")
+    raw = pd.DataFrame({
+        "_time": end - pd.to_timedelta(np.arange(0, 60 * 24 * 30, 10)[::-1], unit="min"),
+        "_value": rng.poisson(20, 60 * 24 * 30 // 10).astype(float),
+    })
+    store = LocalRollupStore()
+    # add the data in three batches
+    for batch in [raw.iloc[:1000], raw.iloc[1000:3000], raw.iloc[3000:]]:
+        store.update("hystreet$1", batch)
+    for tier in ["1h", "1d"]:
+        result = store.load("hystreet$1", tier, 90)
+        expected = rollup(raw, tier)
+        assert np.allclose(result["_value"], expected["sum"] / expected["count"])
+        assert (result["count"].values == expected["count"].values).all()
+        print(f"{tier}: {len(raw)} raw datapoints --> {len(result)} rollups")
+    both = pd.concat([raw.assign(c_id="hystreet$1"), raw.iloc[:100].assign(c_id="hystreet$2")])
+    frame = rollup_frame(both, "1d")
+    assert (frame.loc[frame["c_id"] == "hystreet$1", "count"].values == rollup(raw, "1d")["count"].values).all()
+    assert frame.loc[frame["c_id"] == "hystreet$2", "count"].sum() == 100
+    print(rollup_task_flux("1h", ["pedestrian_count", "personenzahl"]))
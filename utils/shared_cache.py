@@ -0,0 +1,273 @@
+"""
+Cache backend in memory-mapped files that is shared by several worker processes
+
+Every entry is a file in CACHE_DIR with a fixed header
+    magic | version | expiry time | payload length | payload format | metadata length
+followed by the metadata and the payload. Put CACHE_DIR on a tmpfs such as /dev/shm
+so that the files live in shared memory. Writers replace the whole file atomically.
+DataFrames, also as value of a caching.CacheEntry from memoize(), are stored as Arrow
+IPC (without the geometry of a GeoDataFrame, see cache_serializers.ensure_geometry()).
+The other attributes of the CacheEntry (time, versions) are the pickled metadata.
+Readers map the file read-only and the numeric columns are views of the mapped pages,
+so all processes share a single copy of them.
+Other values are pickled, every process that reads them has its own copy.
+The writes are coordinated by caching.memoize(): one process calculates a value
+(single-flight and background refresh markers), all others only attach to it.
+
+Use it in the cache configuration (see README):
+    "CACHE_TYPE": "utils.shared_cache.shared_memory_cache",
+    "CACHE_DIR": "/dev/shm/everyonecounts-slow"
+"""
+
+import fcntl
+import glob
+import hashlib
+import logging
+import os
+import pickle
+import struct
+import time
+import uuid
+from contextlib import contextmanager
+import pandas as pd
+from utils import cache_serializers
+from utils.caching import CacheEntry
+
+MAGIC = b"ECSHM003"
+# magic, version, expiry time (unix time, 0: never), payload length, payload format, metadata length
+HEADER = struct.Struct("<8sQdQBQ")
+PICKLE, ARROW = 0, 1
+SUFFIX = ".shm"
+LOCK_FILE = ".lock"
+
+
+class SharedMemoryCache:
+    """
+    Flask-Caching backend, implements the methods used by flask_caching.Cache
+    """
+
+    def __init__(self, cache_dir, threshold=500, default_timeout=300):
+        self.cache_dir = cache_dir
+        self.threshold = threshold
+        self.default_timeout = default_timeout
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.md5(key.encode()).hexdigest() + SUFFIX)
+
+    def _expiry(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        return time.time() + timeout if timeout else 0
+
+    @staticmethod
+    def _payload(value, key):
+        """
+        Return (payload format, metadata, payload). The metadata of a CacheEntry with a
+        DataFrame is the entry without its value.
+        """
+        entry = value if isinstance(value, CacheEntry) else None
+        frame = entry.value if entry is not None else value
+        if isinstance(frame, pd.DataFrame) and cache_serializers.available():
+            table = cache_serializers.frame_to_table(frame, key)
+            if table is not None:
+                sink = cache_serializers.pa.BufferOutputStream()
+                with cache_serializers.pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+                metadata = b"" if entry is None else pickle.dumps(entry.with_value(None), pickle.HIGHEST_PROTOCOL)
+                return ARROW, metadata, sink.getvalue()
+        return PICKLE, b"", pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def _write_tmp(self, key, value, timeout):
+        payload_format, metadata, payload = self._payload(value, key)
+        header = HEADER.pack(MAGIC, time.time_ns(), self._expiry(timeout), len(payload), payload_format,
+                             len(metadata))
+        tmp_path = os.path.join(self.cache_dir, f".{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            f.write(metadata)
+            f.write(payload)
+        return tmp_path
+
+    @contextmanager
+    def _locked(self):
+        # add() checks and replaces an entry, set() must not replace it in between
+        with open(os.path.join(self.cache_dir, LOCK_FILE), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def read_header(self, key):
+        """
+        Return (version, expiry time, payload length) of an entry or None
+        """
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read(HEADER.size)
+        except FileNotFoundError:
+            return None
+        if len(data) < HEADER.size:
+            return None
+        magic, version, expires, length, _, _ = HEADER.unpack(data)
+        if magic != MAGIC or (expires and expires < time.time()):
+            return None
+        return version, expires, length
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read(HEADER.size)
+                if len(data) < HEADER.size:
+                    return None
+                magic, version, expires, length, payload_format, metadata_length = HEADER.unpack(data)
+                if magic != MAGIC or (expires and expires < time.time()):
+                    return None
+                metadata = pickle.loads(f.read(metadata_length)) if metadata_length else None
+                if payload_format == PICKLE:
+                    return pickle.loads(f.read(length))
+            # the memory map stays valid when the file is replaced, the Arrow buffers keep it open
+            source = cache_serializers.pa.memory_map(path, "r")
+            source.seek(HEADER.size + metadata_length)
+            table = cache_serializers.pa.ipc.open_file(source.read_buffer(length)).read_all()
+            frame = cache_serializers.table_to_frame(table)
+            return frame if metadata is None else metadata.with_value(frame)
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, OSError) as e:
+            logging.warning(f"Unreadable shared cache entry {key}: {e}")
+            return None
+
+    def has(self, key):
+        return self.read_header(key) is not None
+
+    def set(self, key, value, timeout=None):
+        self._prune()
+        tmp_path = self._write_tmp(key, value, timeout)
+        with self._locked():
+            os.replace(tmp_path, self._path(key))
+        return True
+
+    def add(self, key, value, timeout=None):
+        """
+        Store the value only if there is no (unexpired) entry yet. Atomic across processes.
+        """
+        tmp_path = self._write_tmp(key, value, timeout)
+        try:
+            with self._locked():
+                if self.has(key):
+                    return False
+                os.replace(tmp_path, self._path(key))  # also replaces an expired entry
+                return True
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def get_many(self, *keys):
+        return [self.get(key) for key in keys]
+
+    def set_many(self, mapping, timeout=None):
+        for key, value in mapping.items():
+            self.set(key, value, timeout)
+        return list(mapping.keys())
+
+    def delete_many(self, *keys):
+        return [key for key in keys if self.delete(key)]
+
+    def clear(self):
+        for path in glob.glob(os.path.join(self.cache_dir, "*" + SUFFIX)):
+            self._remove(path)
+        return True
+
+    def _prune(self):
+        # remove expired entries and then the oldest ones, like the FileSystemCache
+        paths = glob.glob(os.path.join(self.cache_dir, "*" + SUFFIX))
+        if len(paths) < self.threshold:
+            return
+        entries = []
+        for path in paths:
+            try:
+                with open(path, "rb") as f:
+                    magic, version, expires, length, _, _ = HEADER.unpack(f.read(HEADER.size))
+            except (FileNotFoundError, struct.error):
+                continue
+            if expires and expires < time.time():
+                self._remove(path)
+            else:
+                entries.append((version, path))
+        for version, path in sorted(entries)[:max(0, len(entries) - self.threshold + 1)]:
+            self._remove(path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # removed by another process
+
+
+def shared_memory_cache(app, config, args, kwargs):
+    """
+    Factory for the CACHE_TYPE option of Flask-Caching
+    """
+    kwargs.update(dict(threshold=config.get("CACHE_THRESHOLD", 500)))
+    return SharedMemoryCache(config["CACHE_DIR"], *args, **kwargs)
+
+
+if __name__ == '__main__':
+    """
+    Test: one process writes, the others read the same entry
+    """
+    import multiprocessing
+    import tempfile
+
+    def reader(cache_dir, queue):
+        cache = SharedMemoryCache(cache_dir)
+        while cache.get("map") is None:
+            time.sleep(0.01)
+        queue.put(cache.get("map")["n"])
+
+    print("== TEST ==")
+    directory = tempfile.mkdtemp()
+    shared = SharedMemoryCache(directory, threshold=3)
+    results = multiprocessing.Queue()
+    readers = [multiprocessing.Process(target=reader, args=(directory, results)) for _ in range(3)]
+    for p in readers:
+        p.start()
+    shared.set("map", {"n": 42})
+    for p in readers:
+        p.join()
+    assert [results.get() for _ in readers] == [42, 42, 42]
+    assert shared.add("lock", True, timeout=10) and not shared.add("lock", True, timeout=10)
+    assert shared.add("expired", True, timeout=-1) and shared.add("expired", True, timeout=10)
+    for i in range(5):
+        shared.set(f"key{i}", i)
+    assert len(glob.glob(os.path.join(directory, "*" + SUFFIX))) <= 3
+    frame = pd.DataFrame({"value": range(1000), "name": ["a"] * 1000})
+    shared.set("frame", frame)
+    shared.set("frame2", 1)  # prunes, the mapped frame stays readable
+    cached = shared.get("frame")
+    assert cached.equals(frame) and not cached["value"].values.flags.owndata
+    # memoize() stores a CacheEntry, its DataFrame is Arrow data as well
+    from utils import caching
+
+    @caching.memoize(shared, 60)
+    def load_frame():
+        return frame
+
+    load_frame()
+    with open(shared._path(load_frame.cache_key()), "rb") as f:
+        assert HEADER.unpack(f.read(HEADER.size))[4] == ARROW
+    entry = shared.get(load_frame.cache_key())
+    assert isinstance(entry, CacheEntry) and entry.version == load_frame.cached_version()
+    assert entry.value.equals(frame) and not entry.value["value"].values.flags.owndata
+    print("ok")
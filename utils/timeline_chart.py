@@ -7,8 +7,9 @@ from utils.ec_analytics import matomo_tracking
 
 class TimelineChartWindow:
 
-    def __init__(self, TRENDWINDOW, load_timeseries):
+    def __init__(self, TRENDWINDOW, load_timeseries, load_timeseries_many=None):
         self.load_timeseries = load_timeseries
+        self.load_timeseries_many = load_timeseries_many
         self.TRENDWINDOW = TRENDWINDOW
         self.origin_url = ""
         self.origin_str = ""
@@ -109,8 +110,14 @@ class TimelineChartWindow:
             self.origin_url = ""
             self.origin_str = ""
             self.figure["data"] = []
-            for c_id in filtered_map_data["c_id"].unique():
-                df_timeseries = self.load_timeseries(c_id)
+            c_ids = list(filtered_map_data["c_id"].unique())
+            if self.load_timeseries_many is not None:
+                # all stations of the region with a single query
+                timeseries = self.load_timeseries_many(c_ids)
+            else:
+                timeseries = {c_id: self.load_timeseries(c_id) for c_id in c_ids}
+            for c_id in c_ids:
+                df_timeseries = timeseries[c_id]
                 if df_timeseries is None:
                     continue
                 if min(df_timeseries["_time"]) < first_date:
@@ -0,0 +1,148 @@
+"""
+Static files of the map data
+
+The map traces (per measurement) and the region geometries (per resolution) only
+change when the slow cache is refreshed. They are written to gzipped JSON files
+with the hash of the content in the file name, and the Dash callbacks only send the
+URLs of the current files to the browser (see assets/map_figure.js).
+The files never change, so they are served with a long max-age: browsers and CDNs
+load every version only once. Open pages request the current URLs every URL_REFRESH_S
+seconds, a version is deleted REPLACED_MAX_AGE_S after it was replaced by a newer one,
+so that open pages can still load the files of the URLs they have.
+"""
+
+import datetime
+import glob
+import gzip
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+import uuid
+import numpy as np
+from flask import request, abort, Response
+
+ROUTE = "/map-artifacts"
+MAX_AGE_S = 365 * 24 * 3600
+URL_REFRESH_S = 600
+REPLACED_MAX_AGE_S = 3600
+HASH_LENGTH = 16
+FILENAME_PATTERN = re.compile(r"^[\w.-]+-[0-9a-f]{%d}\.json\.gz$" % HASH_LENGTH)
+
+
+def _json_default(obj):
+    # numpy and pandas values in the traces
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    raise TypeError(f"{type(obj)} is not JSON serializable")
+
+
+def _without_nan(obj):
+    # NaN is not valid JSON, plotly's encoder of the Dash callbacks also writes null
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {k: _without_nan(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_without_nan(x) for x in obj]
+    if isinstance(obj, (np.generic, np.ndarray)):
+        return _without_nan(_json_default(obj))
+    return obj
+
+
+def to_json(obj):
+    return json.dumps(_without_nan(obj), separators=(",", ":"), allow_nan=False, default=_json_default).encode()
+
+
+class ArtifactStore:
+
+    def __init__(self, directory, url_prefix=ROUTE):
+        """
+        :param str directory: directory of the files, shared by all processes
+        :param str url_prefix: URL of the directory, see init_app()
+        """
+        self.directory = directory
+        self.url_prefix = url_prefix
+        self.published = {}  # name -> (version, URL) of the last call
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def publish(self, name, obj, version=None):
+        """
+        Write obj as gzipped JSON file and return its URL
+
+        :param str name: name of the artifact, e.g. "traces-hystreet"
+        :param obj: JSON-compatible object, or a function that returns it
+        :param version: optional version of obj (e.g. of its cache entry), the file is only written again
+            if the version changed. Without version, obj is serialized on every call.
+        """
+        if version is not None:
+            with self._lock:
+                published_version, url = self.published.get(name, (None, None))
+            if published_version == version:
+                return url
+        data = to_json(obj() if callable(obj) else obj)
+        content_hash = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+        filename = f"{name}-{content_hash}.json.gz"
+        path = os.path.join(self.directory, filename)
+        try:
+            os.utime(path)  # the same content again: it is the newest version
+        except FileNotFoundError:
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(gzip.compress(data, mtime=0))
+            os.replace(tmp_path, path)
+        self._remove_replaced(name)
+        url = f"{self.url_prefix}/{filename}"
+        if version is not None:
+            with self._lock:
+                self.published[name] = (version, url)
+        return url
+
+    def _remove_replaced(self, name):
+        # a version was replaced when the next newer one was written
+        versions = []
+        for path in glob.glob(os.path.join(self.directory, f"{glob.escape(name)}-*.json.gz")):
+            filename = os.path.basename(path)
+            if not FILENAME_PATTERN.match(filename) or filename[:-len("-.json.gz") - HASH_LENGTH] != name:
+                continue
+            try:
+                versions.append((os.path.getmtime(path), path))
+            except FileNotFoundError:
+                pass  # removed by another process
+        versions.sort()
+        for (_, path), (replaced, _) in zip(versions, versions[1:]):
+            if replaced < time.time() - REPLACED_MAX_AGE_S:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass  # removed by another process
+
+    def init_app(self, server):
+        server.add_url_rule(f"{self.url_prefix}/<filename>", "map_artifact", self._serve)
+
+    def _serve(self, filename):
+        if not FILENAME_PATTERN.match(filename):
+            abort(404)
+        try:
+            with open(os.path.join(self.directory, filename), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            abort(404)
+        response = Response(mimetype="application/json")
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            response.set_data(data)
+            response.headers["Content-Encoding"] = "gzip"
+        else:
+            response.set_data(gzip.decompress(data))
+        response.headers["Vary"] = "Accept-Encoding"
+        response.headers["Cache-Control"] = f"public, max-age={MAX_AGE_S}, immutable"
+        response.set_etag(filename[-len(".json.gz") - HASH_LENGTH:-len(".json.gz")])
+        return response
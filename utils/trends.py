@@ -0,0 +1,201 @@
+"""
+Vectorized trend calculation for all stations at once.
+
+The data is sorted once and split into groups by c_id. The linear regression
+is done with the closed-form least squares solution on per-group sums, so the
+cost grows linearly with the number of rows instead of stations x rows.
+
+Run this file directly for a benchmark against the old per-station loop.
+"""
+
+import numpy as np
+import pandas as pd
+from datetime import timedelta
+
+COUNT_LOW_THRESHOLD = 3
+PERCENT_NONZEROS_THRESHOLD = 0.75
+NS_PER_S = 10 ** 9
+NS_PER_DAY = 86400 * NS_PER_S
+
+
+def empty_trends():
+    return {
+        "model": {},
+        "trend": {},
+        "last_value": {},
+        "last_time": {}
+    }
+
+
+def calc_trends(df, trend_window=3):
+    """
+    Calculate the trend for every station in df
+
+    :param pandas.DataFrame df: DataFrame with the columns "c_id", "_time" (timezone aware) and "_value".
+        Pre-aggregated data has an additional column "aggregate": The regression is done on the
+        rows with "mean", last_value and last_time are taken from the rows with "last".
+    :param int trend_window: number of days used for the linear regression
+    :return dict: dict of dicts, see queries.load_trend()
+    """
+    if "aggregate" in df.columns:
+        is_last = (df["aggregate"] == "last").values
+        output = calc_trends(df[~is_last].drop(columns="aggregate"), trend_window)
+        last = df[is_last].sort_values(by="_time").drop_duplicates(subset="c_id", keep="last")
+        output["last_value"].update(zip(last["c_id"], last["_value"]))
+        output["last_time"].update(zip(last["c_id"], last["_time"]))
+        return output
+    output = empty_trends()
+    if df.empty:
+        return output
+
+    # sort once by station and time
+    codes, cids = pd.factorize(df["c_id"])
+    time_ns = pd.to_datetime(df["_time"], utc=True).values.astype("datetime64[ns]").astype(np.int64)
+    order = np.lexsort((time_ns, codes))
+    codes = codes[order]
+    time_ns = time_ns[order]
+    times = df["_time"].iloc[order]
+    raw_values = df["_value"].values[order]
+    values = pd.to_numeric(pd.Series(raw_values)).values.astype(float)
+
+    # group boundaries
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    ends = np.r_[starts[1:], len(codes)]
+    counts = ends - starts
+    group = np.repeat(np.arange(len(starts)), counts)
+    group_cids = cids[codes[starts]]
+
+    first_ns = time_ns[starts]
+    last_ns = time_ns[ends - 1]
+    output["last_value"] = dict(zip(group_cids, raw_values[ends - 1]))
+    output["last_time"] = dict(zip(group_cids, times.iloc[ends - 1]))
+
+    # only data inside the trend window is used for the regression
+    covered = (last_ns - first_ns) // NS_PER_DAY >= trend_window - 1
+    day0_ns = last_ns - (trend_window - 1) * NS_PER_DAY
+    in_window = time_ns >= day0_ns[group]
+    window_group = group[in_window]
+    y = values[in_window]
+    # unixtime in s, relative to the last timestamp of each station for numerical stability
+    ref = last_ns // NS_PER_S
+    x = (time_ns[in_window] // NS_PER_S - ref[window_group]).astype(float)
+
+    n_groups = len(starts)
+    n = np.bincount(window_group, minlength=n_groups).astype(float)
+    sx = np.bincount(window_group, weights=x, minlength=n_groups)
+    sy = np.bincount(window_group, weights=y, minlength=n_groups)
+    sxx = np.bincount(window_group, weights=x * x, minlength=n_groups)
+    sxy = np.bincount(window_group, weights=x * y, minlength=n_groups)
+    nonzeros = np.bincount(window_group, weights=(y != 0), minlength=n_groups)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # perform linear regression only when the mean is above COUNT_LOW_THRESHOLD
+        # or if the fraction of non-zero numbers exceeds PERCENT_NONZEROS_THRESHOLD.
+        # This is to suppress unhelpful fits for low-value data sources
+        sufficient = (sy / n > COUNT_LOW_THRESHOLD) | (nonzeros / n > PERCENT_NONZEROS_THRESHOLD)
+        denom = n * sxx - sx * sx
+        valid = covered & sufficient & (denom != 0)
+
+        # linear regression y = a*x + b
+        a = (n * sxy - sx * sy) / denom
+        b_ref = (sy - a * sx) / n
+        b = b_ref - a * ref
+
+        # trend between first day of the window and the last datapoint
+        y1 = a * (day0_ns / NS_PER_S - ref) + b_ref
+        y2 = a * (last_ns / NS_PER_S - ref) + b_ref
+        trend = np.where(valid & (y1 > 0), y2 / y1 - 1, np.nan)
+    a = np.where(valid, a, np.nan)
+    b = np.where(valid, b, np.nan)
+
+    output["model"] = dict(zip(group_cids, zip(a.tolist(), b.tolist())))
+    output["trend"] = dict(zip(group_cids, trend.tolist()))
+    return output
+
+
+def _calc_trends_loop(df, trend_window=3):
+    """
+    Reference implementation: the original per-station loop from queries.load_trend()
+    Only used to check and benchmark calc_trends()
+    """
+    output = empty_trends()
+    df = df.copy()
+    df["unixtime"] = df["_time"].apply(lambda x: int(x.timestamp()))  # unixtime in s
+    for cid in set(df["c_id"]):
+        tmpdf = df[df["c_id"] == cid].sort_values(by=["unixtime"])
+        output["last_value"][cid] = tmpdf["_value"].iloc[-1]
+        output["last_time"][cid] = tmpdf["_time"].iloc[-1]
+        lastday = max(tmpdf["_time"])
+        firstday = min(tmpdf["_time"])
+        if (lastday - firstday).days < trend_window - 1:
+            output["model"][cid] = (np.nan, np.nan)
+            output["trend"][cid] = np.nan
+            continue
+        day0 = lastday - timedelta(days=trend_window - 1)
+        tmpdf = tmpdf[tmpdf["_time"] >= day0]
+        values = pd.to_numeric(tmpdf["_value"])
+        if np.mean(values) > COUNT_LOW_THRESHOLD or \
+                np.count_nonzero(values) / len(values) > PERCENT_NONZEROS_THRESHOLD:
+            a, b = np.polyfit(tmpdf["unixtime"], values, 1)
+            output["model"][cid] = (a, b)
+            y1 = a * day0.timestamp() + b
+            y2 = a * lastday.timestamp() + b
+            output["trend"][cid] = y2 / y1 - 1 if y1 > 0 else np.nan
+        else:
+            output["model"][cid] = (np.nan, np.nan)
+            output["trend"][cid] = np.nan
+    return output
+
+
+def _dummy_data(n_stations, trend_window=3, points_per_day=8, seed=0):
+    """
+    Random station data for the last trend_window + 2 days
+    """
+    rng = np.random.default_rng(seed)
+    n_points = (trend_window + 2) * points_per_day
+    end = pd.Timestamp.now(tz="UTC").floor("s")
+    offsets = rng.integers(0, (trend_window + 2) * 86400, size=(n_stations, n_points))
+    # some stations only have a few days of data
+    offsets[::7] //= trend_window + 2
+    times = end - pd.to_timedelta(offsets.ravel(), unit="s")
+    scale = rng.choice([0.5, 2, 50], size=n_stations)
+    values = rng.poisson(np.repeat(scale, n_points)).astype(float)
+    return pd.DataFrame({
+        "c_id": np.repeat([f"hystreet${i}" for i in range(n_stations)], n_points),
+        "_time": times.tz_convert("Europe/Berlin"),
+        "_value": values,
+    })
+
+
+if __name__ == '__main__':
+    """
+    Benchmark: compare with the per-station loop and measure how
+    calc_trends() scales with the number of stations
+    """
+    from time import perf_counter
+
+    print("== CHECK ==")
+    df = _dummy_data(200)
+    expected = _calc_trends_loop(df)
+    result = calc_trends(df)
+    for key in ["trend", "model"]:
+        exp = np.array([expected[key][cid] for cid in sorted(expected[key])], dtype=float)
+        res = np.array([result[key][cid] for cid in sorted(expected[key])], dtype=float)
+        assert np.allclose(exp, res, rtol=1e-6, equal_nan=True), key
+    assert expected["last_time"] == result["last_time"]
+    print("calc_trends() matches the per-station loop")
+
+    print("\n== BENCHMARK ==")
+    print(f"{'stations':>9} {'rows':>10} {'loop [s]':>10} {'vectorized [s]':>15}")
+    for n_stations in [100, 1000, 10000, 50000]:
+        df = _dummy_data(n_stations)
+        t0 = perf_counter()
+        calc_trends(df)
+        t_vectorized = perf_counter() - t0
+        if n_stations <= 1000:
+            t0 = perf_counter()
+            _calc_trends_loop(df)
+            t_loop = f"{perf_counter() - t0:10.3f}"
+        else:
+            t_loop = f"{'-':>10}"  # takes too long
+        print(f"{n_stations:>9} {len(df):>10} {t_loop} {t_vectorized:15.3f}")